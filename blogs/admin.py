@@ -3,7 +3,8 @@ from django.db.models import Count
 from django.utils.html import escape, format_html
 from django.urls import reverse
 
-from blogs.models import Blog, Post, Stylesheet, Media
+from blogs.models import Blog, Job, Post, Stylesheet, Media
+from blogs.search import matching_post_ids, search_backend
 
 
 admin.site.enable_nav_sidebar = False
@@ -55,6 +56,13 @@ class PostAdmin(admin.ModelAdmin):
     list_filter = ('publish', 'is_page')
     readonly_fields = ('uid', 'last_modified')
 
+    def get_search_results(self, request, queryset, search_term):
+        # Uses the full-text index instead of LIKE scans over every post's content
+        if not search_term or not search_backend():
+            return super().get_search_results(request, queryset, search_term)
+        ids = [post_id for post_id, _ in matching_post_ids(search_term, published_only=False)]
+        return queryset.filter(pk__in=ids), False
+
 
 @admin.register(Media)
 class MediaAdmin(admin.ModelAdmin):
@@ -64,5 +72,13 @@ class MediaAdmin(admin.ModelAdmin):
     readonly_fields = ('created_at',)
 
 
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('name', 'status', 'attempts', 'run_at', 'created_at')
+    list_filter = ('status', 'name')
+    ordering = ('run_at',)
+    readonly_fields = ('created_at', 'started_at', 'error')
+
+
 admin.site.register(Stylesheet)
 
@@ -1,55 +1,152 @@
+from django.conf import settings
 from django.utils import timezone
-import os
+from django.utils.dateparse import parse_datetime
+
+from datetime import timedelta
+import fcntl
+import gzip
+import hashlib
 import json
-from threading import Thread
+import os
+
+from blogs.jobs import enqueue
+
+
+# Backups are a chain of gzipped JSON lines segments in BACKUP_ROOT, each holding the blog and posts that changed
+# since the previous one and the uids of deleted posts. manifest.json lists the segments and the hash of every
+# post as last backed up, so unchanged posts are never written twice.
+# Lines are {"type": "blog" | "post", "uid", "hash", "data"} or {"type": "deleted", "uid"}
+
+BLOG_FIELDS = [
+    'title', 'subdomain', 'nav', 'content', 'meta_description', 'meta_image', 'lang', 'meta_tag', 'blog_path',
+    'header_directive', 'footer_directive', 'custom_styles', 'overwrite_styles', 'favicon', 'optimise_images',
+    'date_format', 'post_template', 'robots_txt', 'rss_alias', 'codemirror_enabled', 'created_date', 'last_modified',
+]
+POST_FIELDS = [
+    'uid', 'title', 'slug', 'alias', 'published_date', 'last_modified', 'all_tags', 'publish', 'is_page', 'content',
+    'canonical_url', 'meta_description', 'meta_image', 'lang', 'class_name',
+]
+DATE_FIELDS = {'created_date', 'last_modified', 'published_date'}
+
+# Changes committed while a backup runs can carry a last_modified from before it started
+CUTOFF_OVERLAP = timedelta(minutes=1)
+
+
+def backup_in_background(blog):
+    """Queues a backup, saves made before it starts are all included in that one backup"""
+    enqueue('backup')
 
 
-def backup_in_thread(blog):
-    """Simplified backup function for personal CMS"""
-    print(f"Backing up {blog.title} in thread")
-    thread = Thread(target=backup_blog, args=(blog,))
-    thread.start()
-    return thread
+def serialise(instance, fields):
+    data = {}
+    for field in fields:
+        value = getattr(instance, field)
+        data[field] = value.isoformat() if field in DATE_FIELDS and value else value
+    return data
 
 
-def backup_blog(blog):
-    """Simple backup function that saves to local files"""
+def deserialise(data):
+    return {field: parse_datetime(value) if field in DATE_FIELDS and value else value for field, value in data.items()}
+
+
+def record(record_type, uid, data):
+    encoded = json.dumps(data, sort_keys=True)
+    return {'type': record_type, 'uid': uid, 'hash': hashlib.sha256(encoded.encode()).hexdigest(), 'data': data}
+
+
+def manifest_path(root):
+    return os.path.join(root, 'manifest.json')
+
+
+def load_manifest(root):
     try:
-        date_str = timezone.now().strftime('%Y-%m-%d')
-        backup_dir = os.path.join('backups', date_str)
-        os.makedirs(backup_dir, exist_ok=True)
-
-        # Save blog data
-        blog_data = {
-            'title': blog.title,
-            'content': blog.content,
-            'meta_description': blog.meta_description,
-            'created_date': blog.created_date.isoformat(),
-            'last_modified': blog.last_modified.isoformat(),
-        }
+        with open(manifest_path(root)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'cutoff': None, 'blog': None, 'posts': {}, 'segments': []}
+
+
+def save_manifest(root, manifest):
+    path = manifest_path(root)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(path + '.tmp', path)
 
-        with open(os.path.join(backup_dir, 'blog.json'), 'w') as f:
-            json.dump(blog_data, f, indent=2)
 
-        # Save posts data
-        posts_data = []
-        for post in blog.posts.all():
-            posts_data.append({
-                'title': post.title,
-                'slug': post.slug,
-                'content': post.content,
-                'published_date': post.published_date.isoformat() if post.published_date else None,
-                'publish': post.publish,
-                'is_page': post.is_page,
-            })
+def changed_records(blog, manifest, full):
+    from blogs.models import Post
 
-        with open(os.path.join(backup_dir, 'posts.json'), 'w') as f:
-            json.dump(posts_data, f, indent=2)
+    blog_record = record('blog', None, serialise(blog, BLOG_FIELDS))
+    if full or blog_record['hash'] != manifest['blog']:
+        yield blog_record
+
+    posts = Post.objects.only(*POST_FIELDS).order_by('id')
+    if not full and manifest['cutoff']:
+        posts = posts.filter(last_modified__gte=parse_datetime(manifest['cutoff']))
+
+    for post in posts.iterator(chunk_size=500):
+        post_record = record('post', post.uid, serialise(post, POST_FIELDS))
+        if full or post_record['hash'] != manifest['posts'].get(post.uid):
+            yield post_record
+
+    existing = set(Post.objects.values_list('uid', flat=True))
+    for uid in sorted(set(manifest['posts']) - existing):
+        yield {'type': 'deleted', 'uid': uid}
+
+
+def backup_blog(blog, full=False, root=None):
+    """Writes a segment with everything that changed since the last backup (or everything, when full)"""
+    root = str(root or settings.BACKUP_ROOT)
+    try:
+        os.makedirs(root, exist_ok=True)
+        # One backup at a time per BACKUP_ROOT, across threads and processes
+        with open(os.path.join(root, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            manifest = load_manifest(root)
+            started_at = timezone.now()
+            full = full or not manifest['segments']
+            name = started_at.strftime('%Y%m%dT%H%M%S%fZ') + ('-full' if full else '') + '.jsonl.gz'
+            path = os.path.join(root, name)
+
+            lines = post_count = deleted_count = 0
+            if full:
+                manifest['posts'] = {}
+            with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as f:
+                for line in changed_records(blog, manifest, full):
+                    f.write(json.dumps(line) + '\n')
+                    lines += 1
+                    if line['type'] == 'blog':
+                        manifest['blog'] = line['hash']
+                    elif line['type'] == 'post':
+                        manifest['posts'][line['uid']] = line['hash']
+                        post_count += 1
+                    else:
+                        del manifest['posts'][line['uid']]
+                        deleted_count += 1
+
+            if lines:
+                os.replace(path + '.tmp', path)
+                manifest['segments'].append({
+                    'file': name,
+                    'created_at': started_at.isoformat(),
+                    'full': full,
+                    'posts': post_count,
+                    'deleted': deleted_count,
+                })
+            else:
+                os.remove(path + '.tmp')
+                name = None
+
+            manifest['cutoff'] = (started_at - CUTOFF_OVERLAP).isoformat()
+            save_manifest(root, manifest)
 
         return {
             'success': True,
-            'backup_date': date_str,
-            'post_count': len(posts_data)
+            'backup_date': started_at.isoformat(),
+            'segment': name,
+            'post_count': post_count,
+            'deleted_count': deleted_count,
         }
 
     except Exception as e:
@@ -57,3 +154,34 @@ def backup_blog(blog):
             'success': False,
             'error': str(e)
         }
+
+
+def restore_segments(manifest, at=None):
+    """Segments needed to restore the backup as of `at`, starting from the latest full backup before it"""
+    segments = [s for s in manifest['segments'] if at is None or parse_datetime(s['created_at']) <= at]
+    starts = [i for i, segment in enumerate(segments) if segment['full']]
+    return segments[starts[-1]:] if starts else segments
+
+
+def read_segments(root, segments):
+    for position, segment in enumerate(segments):
+        with gzip.open(os.path.join(root, segment['file']), 'rt', encoding='utf-8') as f:
+            for line in f:
+                yield position, json.loads(line)
+
+
+def snapshot(root, at=None):
+    """
+    Streams ('blog' | 'post', fields) for the blog and every post as they were at `at`.
+    Only the position of each post's last version is held in memory
+    """
+    manifest = load_manifest(root)
+    segments = restore_segments(manifest, at)
+
+    latest = {}
+    for position, line in read_segments(root, segments):
+        latest[(line['type'] == 'blog', line['uid'])] = (position, line['type'])
+
+    for position, line in read_segments(root, segments):
+        if line['type'] != 'deleted' and latest[(line['type'] == 'blog', line['uid'])] == (position, line['type']):
+            yield line['type'], deserialise(line['data'])
@@ -0,0 +1,186 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import Max
+from django.utils import timezone
+from django.views.decorators.http import condition
+
+from collections import OrderedDict
+from functools import wraps
+import hashlib
+import threading
+import time
+import uuid
+
+
+# The version is read from the database, so every worker process agrees on it. Each process reuses what it read
+# for up to CONTENT_VERSION_POLL_INTERVAL seconds, bumps made in the process are seen immediately
+_local_version = (None, None, 0.0)  # (version, expires_at, read_at)
+_local_version_lock = threading.Lock()
+
+
+def get_content_version():
+    """Version stamp shared through the database, bumped whenever blog content changes"""
+    global _local_version
+
+    version, expires_at, read_at = _local_version
+    now = time.time()
+    if version is None or now - read_at >= settings.CONTENT_VERSION_POLL_INTERVAL:
+        from blogs.models import ContentVersion
+        state = ContentVersion.objects.filter(pk=ContentVersion.SINGLETON_ID).values_list('version', 'expires_at').first()
+        if state is None:
+            return bump_content_version()
+        version, expires_at = state[0], state[1].timestamp() if state[1] else None
+        with _local_version_lock:
+            _local_version = (version, expires_at, now)
+
+    if expires_at is None or now < expires_at:
+        return version
+
+    # A scheduled post has gone live since the last bump
+    from blogs.models import Blog
+    Blog.refresh_post_stats()
+    return bump_content_version()
+
+
+def bump_content_version():
+    global _local_version
+    from blogs.models import ContentVersion, Post
+
+    # The version also expires when the next scheduled post is published
+    next_published_date = Post.objects.filter(publish=True, published_date__gt=timezone.now()).order_by('published_date').values_list('published_date', flat=True).first()
+
+    version = uuid.uuid4().hex
+    # A plain update rather than update_or_create, whose read then write transaction fails straight away on SQLite
+    # when another thread is writing
+    state = {'version': version, 'expires_at': next_published_date}
+    if not ContentVersion.objects.filter(pk=ContentVersion.SINGLETON_ID).update(**state):
+        try:
+            with transaction.atomic():
+                ContentVersion.objects.create(pk=ContentVersion.SINGLETON_ID, **state)
+        except IntegrityError:
+            # Created by another process in the meantime
+            ContentVersion.objects.filter(pk=ContentVersion.SINGLETON_ID).update(**state)
+    with _local_version_lock:
+        _local_version = (version, next_published_date.timestamp() if next_published_date else None, time.time())
+    return version
+
+
+def request_content_version(request):
+    """Content version as first read by this request, so its ETag, Last-Modified and cached body all agree"""
+    if not hasattr(request, '_content_version'):
+        request._content_version = get_content_version()
+    return request._content_version
+
+
+def cache_page(view):
+    """Cache a public view's response until the shared content version changes"""
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return view(request, *args, **kwargs)
+
+        key_parts = [
+            request.get_host(),
+            request.get_full_path(),
+            request.COOKIES.get('timezone', 'UTC'),
+            str(request.user.is_authenticated),
+        ]
+        cache_key = f"page_{request_content_version(request)}_{hashlib.sha256(':'.join(key_parts).encode()).hexdigest()}"
+
+        response = cache.get(cache_key)
+        if response is not None:
+            return response
+
+        response = view(request, *args, **kwargs)
+
+        # Never cache errors, streamed responses or anything setting cookies (eg. CSRF). Nor responses that vary on
+        # request headers the key doesn't cover, or are already encoded for one client
+        if (response.status_code == 200 and not response.streaming and not response.cookies
+                and not response.has_header('Vary') and not response.has_header('Content-Encoding')):
+            cache.set(cache_key, response, settings.PAGE_CACHE_TIMEOUT)
+
+        return response
+    return wrapper
+
+
+def content_etag(request, *args, **kwargs):
+    # Pages also vary by the timezone cookie and whether the owner is logged in
+    variant = f"{request.COOKIES.get('timezone', 'UTC')}:{request.user.is_authenticated}"
+    return f"{request_content_version(request)}-{hashlib.sha256(variant.encode()).hexdigest()[:16]}"
+
+
+def content_last_modified(request, *args, **kwargs):
+    """Latest change to the blog or any published post, computed once per content version"""
+    def latest_change():
+        from blogs.models import Blog, Post
+        dates = [Blog.objects.values_list('last_modified', flat=True).first()]
+        dates.extend(Post.objects.filter(publish=True, published_date__lte=timezone.now()).aggregate(
+            Max('last_modified'),
+            Max('published_date')
+        ).values())
+        return max(filter(None, dates), default=None)
+
+    return cache.get_or_set(f'last_modified_{request_content_version(request)}', latest_change, settings.PAGE_CACHE_TIMEOUT)
+
+
+# Answers If-None-Match / If-Modified-Since with a 304 before the view runs. The version is shared by every worker,
+# so a validator handed out by one is honoured by all of them
+conditional_page = condition(etag_func=content_etag, last_modified_func=content_last_modified)
+
+
+class LRUCache:
+    """Thread-safe in-process LRU cache bounded by entry count and, for str/bytes values, total size"""
+
+    def __init__(self, max_entries=1000, max_size=None):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _sizeof(value):
+        return len(value) if isinstance(value, (str, bytes)) else 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        value_size = self._sizeof(value)
+        if self.max_size is not None and value_size > self.max_size:
+            return
+
+        with self._lock:
+            if key in self._data:
+                self.size -= self._sizeof(self._data.pop(key))
+            self._data[key] = value
+            self.size += value_size
+
+            while len(self._data) > self.max_entries or (self.max_size is not None and self.size > self.max_size):
+                _, evicted = self._data.popitem(last=False)
+                self.size -= self._sizeof(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._data),
+                'size': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
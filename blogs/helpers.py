@@ -1,5 +1,5 @@
 from django.utils import timezone
-from django.core.mail import send_mail, get_connection, EmailMultiAlternatives
+from django.core.mail import get_connection, EmailMultiAlternatives
 from django.conf import settings
 from django.db import connection
 from django.utils.text import slugify
@@ -8,15 +8,51 @@ import re
 import string
 import os
 import random
-import threading
 from requests.exceptions import ConnectionError, ReadTimeout
 import requests
 import subprocess
 from datetime import timedelta
 from time import time
 import hashlib
+import copy
 
-from blogs.models import Post
+from blogs.cache import get_content_version
+from blogs.jobs import enqueue
+from blogs.models import Blog, Post, PostTag
+from blogs.profiling import profile_stage
+
+
+# (content version, blog, loaded at) shared by every request served by this process. The blog is reloaded after
+# BLOG_CACHE_TIMEOUT even if the version hasn't changed, which catches edits that don't bump it (eg. queryset updates)
+_cached_blog = (None, None, 0.0)
+BLOG_CACHE_TIMEOUT = 60  # seconds
+
+
+def get_blog(request=None):
+    """Get the single blog instance, cached per process and memoized per request"""
+    global _cached_blog
+
+    if request is not None and hasattr(request, '_blog'):
+        return request._blog
+
+    with profile_stage('get_blog'):
+        version = get_content_version()
+        cached_version, blog, loaded_at = _cached_blog
+        if blog is None or cached_version != version or time() - loaded_at >= BLOG_CACHE_TIMEOUT:
+            blog = Blog.objects.first()
+            if not blog:
+                # Create default blog if none exists
+                blog = Blog.objects.create(
+                    title="My Personal Blog",
+                    content="Welcome to my personal blog!"
+                )
+            _cached_blog = (version, blog, time())
+
+        # Callers are free to modify their copy (eg. style previews) without affecting the cache
+        blog = copy.copy(blog)
+    if request is not None:
+        request._blog = blog
+    return blog
 
 
 def is_protected(subdomain):
@@ -135,25 +171,80 @@ def get_country(user_ip):
     return {'country_name': 'Unknown'}
 
 
+def filter_by_tags(posts, tags):
+    """Narrow a post queryset to posts carrying all of the given tags"""
+    for tag in tags:
+        # Each filter on the multi-valued relation adds its own join, giving AND semantics
+        posts = posts.filter(tag_index__name=tag)
+    return posts
+
+
+# Markdown constructs removed by unmark, tried left to right in a single pass. The lookahead lets
+# the scan skip positions that can't start any of them (most of the text) in one test
+UNMARK_PATTERN = re.compile(r'(?=[\s#*>`!\[_~+|:\d-])(?:' + '|'.join([
+    r'^\s{0,3}#{1,6}\s+.*$',           # headings
+    r'^\s{0,3}[-*]{3,}\s*$',           # horizontal rules
+    r'^\s{0,3}>\s+.*$',                # blockquotes
+    r'(?s:```.*?```)',                  # fenced code
+    r'`[^`]+`',                         # inline code
+    r'!\[.*?\]\(.*?\)',                 # images
+    r'\[.*?\]\(.*?\)',                  # links
+    r'(?P<strong>\*\*|__).*?(?P=strong)',
+    r'(?P<em>\*|_).*?(?P=em)',
+    r'~~.*?~~',
+    r'^\s{0,3}[-*+]\s+.*$',            # list items
+    r'^\s{0,3}\d+\.\s+.*$',            # numbered list items
+    r'^\s*\|.*?\|\s*$',                # table rows
+    r'^\s*[:-]{3,}\s*$',               # table separators
+]) + ')', flags=re.MULTILINE)
+
+# Markdown syntax removed by plain_text, which keeps the text it wraps. Applied in order
+PLAIN_TEXT_SUBSTITUTIONS = [(re.compile(pattern, flags=re.MULTILINE), replacement) for pattern, replacement in [
+    (r'^\s{0,3}(?:```|~~~).*$', ''),                               # code fences, the code is kept
+    (r'<[^>\n]+>', ' '),                                           # html tags
+    (r'^\s{0,3}(?:[-*_]\s*){3,}$', ''),                            # horizontal rules
+    (r'^\s*\|?(?:\s*:?-{3,}:?\s*\|?)+\s*$', ''),                   # table separators
+    (r'^\s{0,3}(?:#{1,6}\s+|(?:>\s?)+|[-*+]\s+|\d+[.)]\s+)', ''),  # heading, blockquote and list markers
+    (r'!?\[([^\]]*)\]\([^)]*\)', r'\1'),                           # images and links, keeping the alt or link text
+    (r'(`+)(.+?)\1', r'\2'),                                       # inline code
+    (r'(\*\*|~~|\*)(?=\S)(.+?)(?<=\S)\1', r'\2'),                  # emphasis
+    (r'(?<!\w)(__|_)(?=\S)(.+?)(?<=\S)\1(?!\w)', r'\2'),           # emphasis with underscores, which can't be inside words
+    (r'\|', ' '),                                                  # table cells
+]]
+
+FENCED_CODE_PATTERN = re.compile(r'```.*?```', flags=re.DOTALL)
+WORD_PATTERN = re.compile(r'\w+')
+
+WORDS_PER_MINUTE = 200
+
+
 def unmark(content):
-    content = re.sub(r'^\s{0,3}#{1,6}\s+.*$', '', content, flags=re.MULTILINE)
-    content = re.sub(r'^\s{0,3}[-*]{3,}\s*$', '', content, flags=re.MULTILINE)
-    content = re.sub(r'^\s{0,3}>\s+.*$', '', content, flags=re.MULTILINE)
-    content = re.sub(r'```.*?```', '', content, flags=re.DOTALL)
-    content = re.sub(r'`[^`]+`', '', content)
-    content = re.sub(r'!\[.*?\]\(.*?\)', '', content)
-    content = re.sub(r'\[.*?\]\(.*?\)', '', content)
-    content = re.sub(r'(\*\*|__)(.*?)\1', '', content)
-    content = re.sub(r'(\*|_)(.*?)\1', '', content)
-    content = re.sub(r'~~.*?~~', '', content)
-    content = re.sub(r'^\s{0,3}[-*+]\s+.*$', '', content, flags=re.MULTILINE)
-    content = re.sub(r'^\s{0,3}\d+\.\s+.*$', '', content, flags=re.MULTILINE)
-    content = re.sub(r'^\s*\|.*?\|\s*$', '', content, flags=re.MULTILINE)
-    content = re.sub(r'^\s*[:-]{3,}\s*$', '', content, flags=re.MULTILINE)
+    return UNMARK_PATTERN.sub('', content)
 
+
+def plain_text(content):
+    """The text of markdown content without its syntax, for indexing. Unlike unmark nothing it wraps is dropped"""
+    for pattern, replacement in PLAIN_TEXT_SUBSTITUTIONS:
+        content = pattern.sub(replacement, content)
     return content
 
 
+def truncate(text, length):
+    return text if len(text) <= length else text[:length] + '...'
+
+
+def excerpts(content):
+    """Plain text excerpt, meta description, word count and reading time of markdown content, stored at save time"""
+    text = ' '.join(unmark(content).split())
+    word_count = len(WORD_PATTERN.findall(FENCED_CODE_PATTERN.sub('', content)))
+    return {
+        'excerpt': truncate(text, 400),
+        'auto_description': truncate(text, 157),
+        'word_count': word_count,
+        'reading_time': -(-word_count // WORDS_PER_MINUTE),
+    }
+
+
 def clean_text(text):
     return ''.join(c for c in text if valid_xml_char_ordinal(c))
 
@@ -184,30 +275,12 @@ def send_mass_html_mail(datatuple, fail_silently=False, user=None, password=None
     return connection.send_messages(messages)
 
 
-class EmailThread(threading.Thread):
-    def __init__(self, subject, html_message, from_email, recipient_list):
-        self.subject = subject
-        self.html_message = html_message
-        self.from_email = from_email
-        self.recipient_list = recipient_list
-        threading.Thread.__init__(self)
-
-    def run(self):
-        send_mail(
-            self.subject,
-            self.html_message,
-            self.from_email,
-            self.recipient_list,
-            fail_silently=True,
-            html_message=self.html_message)
-
-
 def send_async_mail(subject, html_message, from_email, recipient_list):
     if settings.DEBUG:
         print(html_message)
     else:
         print('Sent email to ', recipient_list)
-        EmailThread(subject, html_message, from_email, recipient_list).start()
+        enqueue('send_mail', subject, html_message, from_email, list(recipient_list))
 
 
 def random_post_link():
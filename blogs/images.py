@@ -0,0 +1,72 @@
+from PIL import Image, ImageOps
+
+import io
+import os
+
+
+# Runs in the upload worker processes, so nothing here may depend on Django being set up
+
+VARIANT_FORMATS = {
+    'webp': ('WEBP', 'image/webp'),
+    'avif': ('AVIF', 'image/avif'),
+}
+
+
+def supported_formats(formats):
+    # AVIF needs a Pillow built with libavif (or the pillow-avif-plugin)
+    Image.init()
+    return [f for f in formats if f in VARIANT_FORMATS and VARIANT_FORMATS[f][0] in Image.SAVE]
+
+
+def transform_image(data, name, content_type, optimise, widths=(), formats=()):
+    """
+    Strips metadata and, when optimising, resizes to 1200px wide WEBP. Also encodes a copy in each
+    format for each width smaller than the image. Returns (data, name, content_type, (width, height), variants)
+    with variants a list of (width, extension, content_type, data)
+    """
+    original_image = Image.open(io.BytesIO(data))
+    # Keeps orientation information
+    image = ImageOps.exif_transpose(original_image)
+    variants = image_variants(image, widths, formats, skip=(1200, 'webp') if optimise else None)
+
+    output = io.BytesIO()
+
+    if optimise:
+        max_width = 1200
+        if image.width > max_width:
+            # Calculate the new height to maintain the aspect ratio
+            ratio = max_width / float(image.width)
+            new_height = int(float(image.height) * ratio)
+            # Resize the image with high-quality resampling
+            image = image.resize((max_width, new_height), resample=Image.LANCZOS)
+
+        image.save(output, format='WEBP')
+        # Update file name and content type for WebP
+        name = os.path.splitext(name)[0] + '.webp'
+        content_type = 'image/webp'
+    else:
+        if image.mode == 'P':
+            image = image.convert('RGB')
+        # Save the image to strip metadata (EXIF, etc.)
+        image.save(output, format=original_image.format)
+
+    return output.getvalue(), name, content_type, image.size, variants
+
+
+def image_variants(image, widths, formats, skip=None):
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'A' in image.mode or 'transparency' in image.info else 'RGB')
+
+    variants = []
+    for width in sorted(widths):
+        if width >= image.width:
+            break
+        resized = image.resize((width, round(image.height * width / image.width)), resample=Image.LANCZOS)
+        for extension in supported_formats(formats):
+            # The optimised upload already is this variant
+            if (width, extension) == skip:
+                continue
+            output = io.BytesIO()
+            resized.save(output, format=VARIANT_FORMATS[extension][0])
+            variants.append((width, extension, VARIANT_FORMATS[extension][1], output.getvalue()))
+    return variants
@@ -0,0 +1,205 @@
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from collections import namedtuple
+from datetime import timedelta
+import heapq
+import itertools
+import json
+import threading
+import time
+import traceback
+
+
+# Side effects of a request (backups, stats refreshes, emails) run here instead of on a thread of their own.
+# Jobs are registered by name so the database backend can store them and run them in `manage.py run_jobs`
+
+JobType = namedtuple('JobType', ['function', 'retries', 'coalesce', 'delay'])
+
+registry = {}
+
+
+def job(name=None, retries=settings.JOB_RETRIES, coalesce=True, delay=0):
+    """
+    Registers a job. Coalesced jobs are queued at most once per set of arguments until they start,
+    and delayed ones wait that many seconds first, so a burst of saves collapses into a single run
+    """
+    def decorator(function):
+        registry[name or function.__name__] = JobType(function, retries, coalesce, delay)
+        return function
+    return decorator
+
+
+def enqueue(name, *args, **kwargs):
+    job_type = registry[name]
+    arguments = json.dumps([args, kwargs], sort_keys=True)
+    key = f'{name}:{arguments}' if job_type.coalesce else ''
+    get_queue().enqueue(name, arguments, key, job_type.delay)
+
+
+def run_job(name, arguments):
+    args, kwargs = json.loads(arguments)
+    registry[name].function(*args, **kwargs)
+
+
+def retry_delay(attempts):
+    return settings.JOB_RETRY_DELAY * 2 ** (attempts - 1)
+
+
+class ThreadQueue:
+    """In-process queue worked by a few daemon threads. Jobs still queued when the process exits are lost"""
+
+    def __init__(self, workers, max_size):
+        self.workers = workers
+        self.max_size = max_size
+        self.heap = []  # (run at, sequence, name, arguments, key, attempts)
+        self.pending_keys = set()
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self._threads = []
+
+    def enqueue(self, name, arguments, key, delay):
+        # Workers must see the data the job was queued for
+        transaction.on_commit(lambda: self.put(name, arguments, key, time.time() + delay))
+
+    def put(self, name, arguments, key, run_at, attempts=0):
+        self._ensure_workers()
+        with self.condition:
+            # A retry is redundant when a fresh run is already queued
+            if key and key in self.pending_keys:
+                return False
+            if len(self.heap) >= self.max_size:
+                print(f'Job queue full, dropped {name}')
+                return False
+            if key:
+                self.pending_keys.add(key)
+            heapq.heappush(self.heap, (run_at, next(self.sequence), name, arguments, key, attempts))
+            self.condition.notify()
+            return True
+
+    def _ensure_workers(self):
+        if len(self._threads) < self.workers or not all(thread.is_alive() for thread in self._threads):
+            with self.condition:
+                self._threads = [thread for thread in self._threads if thread.is_alive()]
+                while len(self._threads) < self.workers:
+                    thread = threading.Thread(target=self._run, daemon=True, name=f'jobs-{len(self._threads)}')
+                    thread.start()
+                    self._threads.append(thread)
+
+    def _take(self):
+        with self.condition:
+            while not self.heap or self.heap[0][0] > time.time():
+                self.condition.wait(self.heap[0][0] - time.time() if self.heap else None)
+            run_at, _, name, arguments, key, attempts = heapq.heappop(self.heap)
+            # Anything queued from now on happened after this run started, so it needs a run of its own
+            self.pending_keys.discard(key)
+            return name, arguments, key, attempts
+
+    def _run(self):
+        while True:
+            name, arguments, key, attempts = self._take()
+            try:
+                run_job(name, arguments)
+            except Exception:
+                attempts += 1
+                if attempts <= registry[name].retries:
+                    self.put(name, arguments, key, time.time() + retry_delay(attempts), attempts)
+                else:
+                    print(f'Job {name} failed after {attempts} attempts')
+                    traceback.print_exc()
+            finally:
+                close_old_connections()
+
+    def size(self):
+        with self.condition:
+            return len(self.heap)
+
+
+class DatabaseQueue:
+    """Durable queue stored in the Job table and worked by `manage.py run_jobs`"""
+
+    def enqueue(self, name, arguments, key, delay):
+        from blogs.models import Job
+        # Inserted in the caller's transaction, so the job exists exactly when its data does
+        if key and Job.objects.filter(key=key, status=Job.PENDING).exists():
+            return
+        Job.objects.create(name=name, arguments=arguments, key=key, run_at=timezone.now() + timedelta(seconds=delay))
+
+    def claim(self):
+        """Marks the next due job as running, unless another worker got to it first"""
+        from blogs.models import Job
+        for job in Job.objects.filter(status=Job.PENDING, run_at__lte=timezone.now()).order_by('run_at', 'id')[:10]:
+            if Job.objects.filter(pk=job.pk, status=Job.PENDING).update(status=Job.RUNNING, started_at=timezone.now()):
+                return job
+        return None
+
+    def run_next(self):
+        """Runs one due job, returns False when there are none"""
+        job = self.claim()
+        if job is None:
+            return False
+
+        try:
+            run_job(job.name, job.arguments)
+        except Exception:
+            job.attempts += 1
+            job.error = traceback.format_exc()
+            if job.name in registry and job.attempts <= registry[job.name].retries:
+                job.status = job.PENDING
+                job.run_at = timezone.now() + timedelta(seconds=retry_delay(job.attempts))
+            else:
+                job.status = job.FAILED
+            job.save(update_fields=['attempts', 'error', 'status', 'run_at'])
+        else:
+            job.delete()
+        return True
+
+    def requeue_stale(self, after):
+        """Jobs left running by a worker that died"""
+        from blogs.models import Job
+        return Job.objects.filter(status=Job.RUNNING, started_at__lt=timezone.now() - timedelta(seconds=after)).update(status=Job.PENDING)
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue():
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                if settings.JOB_BACKEND == 'database':
+                    _queue = DatabaseQueue()
+                else:
+                    _queue = ThreadQueue(settings.JOB_WORKERS, settings.JOB_QUEUE_SIZE)
+    return _queue
+
+
+# Jobs
+
+@job(delay=settings.BACKUP_DELAY)
+def backup():
+    from blogs.backup import backup_blog
+    from blogs.models import Blog
+    blog = Blog.objects.first()
+    if blog:
+        result = backup_blog(blog)
+        if not result['success']:
+            raise RuntimeError(result['error'])
+
+
+@job()
+def refresh_post_stats():
+    from blogs.cache import bump_content_version
+    from blogs.models import Blog
+    Blog.refresh_post_stats()
+    # Post.save bumped the version before this ran, pages cached since then show the old tags and last posted date
+    bump_content_version()
+
+
+@job(coalesce=False)
+def send_mail(subject, html_message, from_email, recipient_list):
+    from django.core.mail import send_mail
+    send_mail(subject, html_message, from_email, recipient_list, html_message=html_message)
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from blogs.backup import backup_blog
+from blogs.models import Blog
+
+
+class Command(BaseCommand):
+    help = 'Backs up the posts that changed since the last backup (or all of them with --full)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help='Start a new chain with every post, eg. weekly from cron')
+        parser.add_argument('--root', help='Backup directory, defaults to BACKUP_ROOT')
+
+    def handle(self, *args, **options):
+        blog = Blog.objects.first()
+        if blog is None:
+            raise CommandError('There is no blog to back up')
+
+        result = backup_blog(blog, full=options['full'], root=options['root'])
+        if not result['success']:
+            raise CommandError(f"Backup failed: {result['error']}")
+
+        if result['segment']:
+            self.stdout.write(self.style.SUCCESS(
+                f"Backed up {result['post_count']} posts and {result['deleted_count']} deletions to {result['segment']}"))
+        else:
+            self.stdout.write(self.style.SUCCESS('Nothing changed since the last backup'))
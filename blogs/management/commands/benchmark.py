@@ -0,0 +1,237 @@
+from django.core.cache import caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.contrib.auth.models import AnonymousUser
+from django.test import RequestFactory
+from django.utils import timezone
+
+from blogs.cache import bump_content_version
+from blogs.helpers import get_blog, unmark
+from blogs.models import Blog, Post, PostTag
+from blogs.search import rebuild_index, search_posts
+from blogs.templatetags.custom_tags import highlight_cache, markdown
+from blogs.views.blog import posts, sitemap
+from blogs.views.feed import generate_feed
+from blogs.views.media import process_image
+
+from contextlib import redirect_stdout
+from datetime import timedelta
+from PIL import Image
+import django
+import inspect
+import io
+import json
+import platform
+import random
+import statistics
+import time
+import tracemalloc
+
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore et '
+         'dolore magna aliqua enim ad minim veniam quis nostrud exercitation ullamco laboris nisi aliquip').split()
+
+CODE_BLOCK = '''```python
+def fibonacci(n):
+    """Return the nth Fibonacci number"""
+    a, b = 0, 1
+    for _ in range(n):
+        a, b = b, a + b
+    return a
+```'''
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks the render, feed, listing and upload hot paths against a synthetic blog (rolled back afterwards)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--posts', type=int, default=200, help='Number of synthetic posts')
+        parser.add_argument('--words', type=int, default=800, help='Approximate words per post')
+        parser.add_argument('--tags', type=int, default=30, help='Number of distinct tags')
+        parser.add_argument('--tags-per-post', type=int, default=3)
+        parser.add_argument('--code-density', type=float, default=0.3, help='Code blocks per 1000 words')
+        parser.add_argument('--iterations', type=int, default=5)
+        parser.add_argument('--warm', action='store_true', help="Keep the markdown and highlight caches between iterations")
+        parser.add_argument('--only', nargs='*', help='Only run these benchmarks')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--output', help='Write the results as JSON to this file')
+        parser.add_argument('--compare', help='JSON results of a previous run to compare against')
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.random = random.Random(options['seed'])
+
+        try:
+            with transaction.atomic():
+                self.seed()
+                results = self.run_benchmarks()
+                raise Rollback
+        except Rollback:
+            pass
+        finally:
+            # Nothing seeded should survive in the shared caches
+            bump_content_version()
+
+        report = {
+            'timestamp': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'parameters': {key: options[key] for key in ('posts', 'words', 'tags', 'tags_per_post', 'code_density', 'iterations', 'warm', 'seed')},
+            'results': results,
+        }
+
+        previous = None
+        if options['compare']:
+            with open(options['compare']) as f:
+                previous = json.load(f)['results']
+        self.print_report(results, previous)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Results written to {options['output']}"))
+
+    def seed(self):
+        options = self.options
+        tags = [f'tag-{i}' for i in range(options['tags'])]
+        now = timezone.now()
+
+        self.blog = get_blog()
+        self.contents = []
+        new_posts = []
+        for i in range(options['posts']):
+            content = self.generate_content()
+            self.contents.append(content)
+            post_tags = self.random.sample(tags, min(options['tags_per_post'], len(tags)))
+            new_posts.append(Post(
+                uid=f'benchmark-{i}',
+                title=f'Benchmark post {i}',
+                slug=f'benchmark-post-{i}',
+                published_date=now - timedelta(hours=i),
+                all_tags=json.dumps(post_tags),
+                content=content,
+            ))
+
+        created = Post.objects.bulk_create(new_posts, batch_size=500)
+        if any(post.pk is None for post in created):
+            created = Post.objects.filter(uid__startswith='benchmark-')
+        PostTag.objects.bulk_create([PostTag(post=post, name=tag) for post in created for tag in post.tags], batch_size=1000)
+        Blog.refresh_post_stats()
+        rebuild_index(Post.objects.all())
+        bump_content_version()
+
+        self.tags = tags
+        self.stdout.write(f"Seeded {options['posts']} posts ({Post.objects.count()} in total)")
+
+    def generate_content(self):
+        options = self.options
+        paragraphs = []
+        words = 0
+        while words < options['words']:
+            length = self.random.randint(40, 120)
+            paragraphs.append(' '.join(self.random.choices(WORDS, k=length)).capitalize() + '.')
+            words += length
+            if self.random.random() < options['code_density'] * length / 1000:
+                paragraphs.append(CODE_BLOCK)
+            if self.random.random() < 0.2:
+                paragraphs.append(f"## {' '.join(self.random.choices(WORDS, k=4)).title()}")
+            if self.random.random() < 0.1:
+                paragraphs.append('- [A link](https://example.com)\n- *Emphasis* and **strong**\n- `inline code`')
+        return '\n\n'.join(paragraphs)
+
+    def request(self, path):
+        request = RequestFactory().get(path, HTTP_HOST='localhost')
+        request.user = AnonymousUser()
+        return request
+
+    def benchmarks(self):
+        # Views are unwrapped so the page cache and conditional GET handling don't short-circuit them
+        posts_view = inspect.unwrap(posts)
+        sitemap_view = inspect.unwrap(sitemap)
+        tag = self.tags[0]
+        tag_pair = ','.join(self.tags[:2])
+        image = self.generate_image()
+
+        return {
+            'markdown': (len(self.contents), lambda: [markdown(content, self.blog) for content in self.contents]),
+            'unmark': (len(self.contents), lambda: [unmark(content) for content in self.contents]),
+            'generate_feed': (1, lambda: generate_feed(self.blog, 'atom')),
+            'generate_feed_tagged': (1, lambda: generate_feed(self.blog, 'atom', tag)),
+            'posts': (1, lambda: posts_view(self.request('/blog/'))),
+            'posts_tagged': (1, lambda: posts_view(self.request(f'/blog/?q={tag_pair}'))),
+            'search': (1, lambda: search_posts('veniam')),
+            'search_prefix': (1, lambda: search_posts('exercit')),
+            'sitemap': (1, lambda: self.consume(sitemap_view(self.request('/sitemap.xml')))),
+            'blog_save': (1, lambda: Blog.objects.first().save()),
+            'update_all_tags': (1, lambda: Blog.objects.first().update_all_tags()),
+            'process_image': (1, lambda: process_image(SimpleUploadedFile('benchmark.jpg', image, content_type='image/jpeg'), True)),
+        }
+
+    def generate_image(self):
+        image = Image.effect_noise((2400, 1600), 64).convert('RGB')
+        data = io.BytesIO()
+        image.save(data, format='JPEG', quality=90)
+        return data.getvalue()
+
+    def consume(self, response):
+        return b''.join(response.streaming_content) if response.streaming else response.content
+
+    def reset_caches(self):
+        if not self.options['warm']:
+            caches['markdown'].clear()
+            highlight_cache.clear()
+            bump_content_version()
+
+    def run_benchmarks(self):
+        results = {}
+        only = self.options['only']
+        for name, (operations, function) in self.benchmarks().items():
+            if only and name not in only:
+                continue
+
+            # process_image reports its compression rate on stdout
+            with redirect_stdout(io.StringIO()):
+                self.reset_caches()
+                function()  # warm up imports, lexers and the connection
+
+                timings = []
+                for _ in range(self.options['iterations']):
+                    self.reset_caches()
+                    start = time.perf_counter()
+                    function()
+                    timings.append(time.perf_counter() - start)
+
+                # Memory is measured on a separate run, tracemalloc skews the timings
+                self.reset_caches()
+                tracemalloc.start()
+                function()
+                peak_memory = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+
+            mean = statistics.mean(timings)
+            results[name] = {
+                'operations': operations,
+                'mean': mean,
+                'median': statistics.median(timings),
+                'min': min(timings),
+                'max': max(timings),
+                'stdev': statistics.stdev(timings) if len(timings) > 1 else 0.0,
+                'ops_per_second': operations / mean if mean else None,
+                'peak_memory_kb': peak_memory / 1024,
+            }
+        return results
+
+    def print_report(self, results, previous=None):
+        for name, result in results.items():
+            line = f"{name:<22}{result['mean'] * 1000:>10.2f} ms{result['ops_per_second']:>12.1f} ops/s{result['peak_memory_kb']:>12.0f} KB"
+            if previous and name in previous:
+                change = (result['mean'] - previous[name]['mean']) / previous[name]['mean'] * 100
+                style = self.style.ERROR if change > 10 else self.style.SUCCESS if change < -10 else str
+                line += style(f'{change:>+9.1f}%')
+            self.stdout.write(line)
@@ -0,0 +1,250 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.text import slugify
+
+from datetime import datetime
+from zoneinfo import ZoneInfo
+import gzip
+import json
+import os
+import xml.etree.ElementTree as ElementTree
+
+from blogs.backup import POST_FIELDS, deserialise, snapshot
+from blogs.cache import bump_content_version
+from blogs.models import Blog, Post, PostTag
+from blogs.search import index_posts
+from blogs.views.studio import clean_slug, parse_post_header
+
+
+MARKDOWN_EXTENSIONS = ('.md', '.markdown')
+
+# Common front matter names (Jekyll, Hugo) for the header options studio understands
+HEADER_ALIASES = {'date': 'published_date', 'slug': 'link', 'description': 'meta_description'}
+
+# WordPress posts in these states are imported as drafts, anything else (trash, auto-draft) is skipped
+WORDPRESS_STATUSES = {'publish': True, 'future': True, 'draft': False, 'pending': False, 'private': False}
+
+
+class Command(BaseCommand):
+    help = ('Bulk imports posts from backups (a backup directory, .jsonl(.gz) segment or posts.json), markdown files '
+            'with a studio style header, or a WordPress or Atom export')
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+')
+        parser.add_argument('--format', choices=['auto', 'backup', 'markdown', 'wordpress', 'atom'], default='auto')
+        parser.add_argument('--timezone', default='UTC', help='Timezone of dates in markdown headers')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--dry-run', action='store_true', help='Report what would be imported without saving it')
+
+    def handle(self, *args, **options):
+        self.options = options
+
+        with transaction.atomic():
+            created, skipped = self.import_posts(self.records(options['paths']))
+
+            # Done once for the whole import instead of after every post
+            Blog.refresh_post_stats()
+            if options['dry_run']:
+                transaction.set_rollback(True)
+
+        if not options['dry_run']:
+            bump_content_version()
+        self.stdout.write(self.style.SUCCESS(
+            f"{'Would import' if options['dry_run'] else 'Imported'} {created} posts, skipped {skipped} already imported"))
+
+    def records(self, paths):
+        for path in paths:
+            if not os.path.exists(path):
+                raise CommandError(f'{path} does not exist')
+            reader = getattr(self, f'read_{self.detect_format(path)}')
+            yield from reader(path)
+
+    def detect_format(self, path):
+        if self.options['format'] != 'auto':
+            return self.options['format']
+        if os.path.isdir(path):
+            return 'backup' if os.path.exists(os.path.join(path, 'manifest.json')) else 'markdown'
+        if path.endswith(MARKDOWN_EXTENSIONS):
+            return 'markdown'
+        if path.endswith(('.json', '.jsonl', '.jsonl.gz')):
+            return 'backup'
+
+        with open(path, 'rb') as f:
+            for _, element in ElementTree.iterparse(f, events=('start',)):
+                return 'atom' if self.local_name(element.tag) == 'feed' else 'wordpress'
+
+    # Readers yield the fields of each post
+
+    def read_backup(self, path):
+        if os.path.isdir(path):
+            for record_type, data in snapshot(path):
+                if record_type == 'post':
+                    yield data
+            return
+
+        with (gzip.open if path.endswith('.gz') else open)(path, 'rt', encoding='utf-8') as f:
+            # posts.json written by earlier versions of the backup, or a segment
+            lines = json.load(f) if path.endswith('.json') else (json.loads(line) for line in f)
+            for line in lines:
+                if line.get('type', 'post') == 'post':
+                    data = line.get('data', line)
+                    yield deserialise({field: value for field, value in data.items() if field in POST_FIELDS})
+
+    def read_markdown(self, path):
+        if os.path.isdir(path):
+            for directory, _, files in sorted(os.walk(path)):
+                for name in sorted(files):
+                    if name.endswith(MARKDOWN_EXTENSIONS):
+                        yield from self.read_markdown(os.path.join(directory, name))
+            return
+
+        with open(path, encoding='utf-8') as f:
+            lines = f.read().replace('\r\n', '\n').split('\n')
+
+        header = []
+        if lines and lines[0].strip() == '---' and '---' in lines[1:]:
+            # Front matter
+            end = lines.index('---', 1)
+            header = [self.front_matter_line(line) for line in lines[1:end] if line.strip()]
+            lines = lines[end + 1:]
+        elif '___' in lines:
+            end = lines.index('___')
+            header = [line for line in lines[:end] if line.strip()]
+            lines = lines[end + 1:]
+
+        stem = os.path.splitext(os.path.basename(path))[0]
+        post = Post(
+            title=stem.replace('-', ' ').replace('_', ' ').capitalize(),
+            published_date=datetime.fromtimestamp(os.path.getmtime(path), tz=ZoneInfo('UTC')),
+        )
+        slug, errors = parse_post_header(post, header, self.options['timezone'])
+        for error in errors:
+            self.stderr.write(f'{path}: {error}')
+
+        yield {
+            'title': post.title,
+            'slug': slug or stem,
+            'alias': post.alias,
+            'published_date': post.published_date,
+            'all_tags': post.all_tags,
+            'is_page': post.is_page,
+            'content': '\n'.join(lines).strip(),
+            'canonical_url': post.canonical_url,
+            'meta_description': post.meta_description,
+            'meta_image': post.meta_image,
+            'lang': post.lang,
+            'class_name': post.class_name,
+        }
+
+    def front_matter_line(self, line):
+        name, _, value = line.partition(':')
+        name = HEADER_ALIASES.get(name.strip(), name.strip())
+        value = value.strip().strip('"\'')
+        if name == 'tags':
+            value = value.strip('[]').replace('"', '').replace("'", '')
+        return f'{name}: {value}'
+
+    def read_wordpress(self, path):
+        for item in self.iterate_elements(path, 'item'):
+            # content:encoded and excerpt:encoded only differ by namespace
+            fields = {'excerpt' if 'excerpt' in child.tag else self.local_name(child.tag): child for child in item}
+            status = self.text(fields.get('status'))
+            post_type = self.text(fields.get('post_type')) or 'post'
+            if post_type not in ('post', 'page') or status not in WORDPRESS_STATUSES:
+                continue
+
+            date = self.text(fields.get('post_date_gmt'))
+            published_date = parse_datetime(date) if date and not date.startswith('0000') else None
+            tags = [self.text(child) for child in item if self.local_name(child.tag) == 'category' and child.get('domain') in ('post_tag', 'category')]
+
+            yield {
+                'title': self.text(fields.get('title')),
+                'slug': self.text(fields.get('post_name')),
+                'published_date': timezone.make_aware(published_date, ZoneInfo('UTC')) if published_date else None,
+                'all_tags': json.dumps(list(dict.fromkeys(tags))),
+                'publish': WORDPRESS_STATUSES[status],
+                'is_page': post_type == 'page',
+                'content': self.text(fields.get('encoded')),
+                'meta_description': self.text(fields.get('excerpt'))[:200],
+            }
+
+    def read_atom(self, path):
+        for entry in self.iterate_elements(path, 'entry'):
+            fields = {self.local_name(child.tag): child for child in entry}
+            link = next((child.get('href') for child in entry if self.local_name(child.tag) == 'link' and child.get('rel', 'alternate') == 'alternate'), '')
+            date = self.text(fields.get('published')) or self.text(fields.get('updated'))
+            tags = [child.get('term') for child in entry if self.local_name(child.tag) == 'category' and child.get('term')]
+
+            yield {
+                'title': self.text(fields.get('title')),
+                'slug': link.rstrip('/').rsplit('/', 1)[-1] if link else '',
+                'published_date': parse_datetime(date) if date else None,
+                'all_tags': json.dumps(list(dict.fromkeys(tags))),
+                'content': self.text(fields.get('content')) or self.text(fields.get('summary')),
+                'canonical_url': link[:200],
+            }
+
+    def iterate_elements(self, path, name):
+        """Streams the elements called name, clearing each once read so large exports aren't held in memory"""
+        with open(path, 'rb') as f:
+            for _, element in ElementTree.iterparse(f):
+                if self.local_name(element.tag) == name:
+                    yield element
+                    element.clear()
+
+    def local_name(self, tag):
+        return tag.rsplit('}', 1)[-1]
+
+    def text(self, element):
+        return (element.text or '').strip() if element is not None else ''
+
+    def import_posts(self, records):
+        batch_size = self.options['batch_size']
+        existing_uids = set(Post.objects.values_list('uid', flat=True))
+        taken_slugs = set(Post.objects.values_list('slug', flat=True))
+        now = timezone.now()
+        created = skipped = 0
+        batch = []
+
+        for data in records:
+            post = Post(**data)
+            if post.uid in existing_uids:
+                skipped += 1
+                continue
+            post.uid = post.uid or Post.generate_uid()
+            existing_uids.add(post.uid)
+
+            post.title = post.title or 'New post'
+            post.published_date = post.published_date or now
+            post.all_tags = post.all_tags or '[]'
+            post.slug = self.unique_slug(post, taken_slugs)
+            post.update_excerpts()
+
+            batch.append(post)
+            if len(batch) >= batch_size:
+                created += self.create(batch)
+                batch = []
+        created += self.create(batch)
+
+        return created, skipped
+
+    def unique_slug(self, post, taken_slugs):
+        # As studio's unique_slug, against the slugs already taken instead of a query per post
+        slug = clean_slug(post.slug or '') or slugify(post.title) or post.uid.lower()
+        new_stack = '-new'
+        while slug in taken_slugs:
+            slug = f'{slug}{new_stack}'
+            new_stack += '-new'
+        taken_slugs.add(slug)
+        return slug
+
+    def create(self, batch):
+        """Inserts the posts with their tag index and search index rows without going through Post.save"""
+        posts = Post.objects.bulk_create(batch)
+        if any(post.pk is None for post in posts):
+            posts = Post.objects.filter(uid__in=[post.uid for post in batch]).only('id', 'title', 'content', 'all_tags')
+        PostTag.objects.bulk_create([PostTag(post=post, name=tag) for post in posts for tag in post.tags], ignore_conflicts=True)
+        index_posts([(post.pk, post.title, post.content, post.all_tags) for post in posts])
+        return len(batch)
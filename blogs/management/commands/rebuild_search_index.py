@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from blogs.models import Post
+from blogs.search import create_index, rebuild_index, search_backend
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the full-text search index of posts (eg. after changing unmark or bulk edits in the database)'
+
+    def handle(self, *args, **options):
+        if not search_backend():
+            self.stdout.write('This database has no full-text index, search falls back to scanning posts')
+            return
+
+        with transaction.atomic():
+            create_index()
+            count = rebuild_index(Post.objects.all())
+        self.stdout.write(self.style.SUCCESS(f'Indexed {count} posts'))
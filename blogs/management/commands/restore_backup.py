@@ -0,0 +1,101 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from blogs.backup import load_manifest, restore_segments, snapshot
+from blogs.cache import bump_content_version
+from blogs.helpers import excerpts
+from blogs.models import Blog, Post, PostTag
+from blogs.search import rebuild_index
+
+
+class Command(BaseCommand):
+    help = 'Restores the blog and its posts from the incremental backups, as they were at a point in time'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--at', help='ISO date and time to restore to, defaults to the latest backup')
+        parser.add_argument('--root', help='Backup directory, defaults to BACKUP_ROOT')
+        parser.add_argument('--keep-missing', action='store_true', help="Keep posts that aren't in the backup")
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--dry-run', action='store_true', help='Report what would change without saving it')
+
+    def handle(self, *args, **options):
+        root = str(options['root'] or settings.BACKUP_ROOT)
+        at = None
+        if options['at']:
+            at = parse_datetime(options['at'])
+            if at is None:
+                raise CommandError(f"Couldn't parse --at {options['at']}")
+            if timezone.is_naive(at):
+                at = timezone.make_aware(at)
+
+        segments = restore_segments(load_manifest(root), at)
+        if not segments:
+            raise CommandError(f'No backups in {root} to restore from')
+        self.stdout.write(f"Restoring from {len(segments)} segments up to {segments[-1]['created_at']}")
+
+        with transaction.atomic():
+            created, updated, deleted = self.restore(root, at, options)
+            if options['dry_run']:
+                transaction.set_rollback(True)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"{'Would restore' if options['dry_run'] else 'Restored'} {created} new and {updated} existing posts, "
+            f"{'would delete' if options['dry_run'] else 'deleted'} {deleted}"))
+
+    def restore(self, root, at, options):
+        batch_size = options['batch_size']
+        existing = dict(Post.objects.values_list('uid', 'id'))
+        restored = set()
+        blog_data = None
+        batch = []
+        created = updated = 0
+
+        now = timezone.now()
+
+        for record_type, data in snapshot(root, at):
+            if record_type == 'blog':
+                blog_data = data
+                continue
+
+            data.update(excerpts(data['content']))
+            # Restored posts count as modified now so the next incremental backup records them. update() skips
+            # auto_now, bulk_create applies it
+            data['last_modified'] = now
+            restored.add(data['uid'])
+            if data['uid'] in existing:
+                updated += Post.objects.filter(pk=existing[data['uid']]).update(**data)
+            else:
+                batch.append(Post(**data))
+                if len(batch) >= batch_size:
+                    created += len(Post.objects.bulk_create(batch))
+                    batch = []
+        created += len(Post.objects.bulk_create(batch))
+
+        deleted = 0
+        if not options['keep_missing']:
+            _, deleted_by_model = Post.objects.filter(uid__in=set(existing) - restored).delete()
+            deleted = deleted_by_model.get('blogs.Post', 0)
+
+        # The tag index is rebuilt in one pass rather than per post
+        PostTag.objects.all().delete()
+        tags = []
+        for post in Post.objects.only('id', 'all_tags').iterator(chunk_size=batch_size):
+            tags.extend(PostTag(post=post, name=tag) for tag in post.tags)
+            if len(tags) >= batch_size:
+                PostTag.objects.bulk_create(tags, ignore_conflicts=True)
+                tags = []
+        PostTag.objects.bulk_create(tags, ignore_conflicts=True)
+
+        if blog_data:
+            blog = Blog.objects.first() or Blog()
+            for field, value in blog_data.items():
+                setattr(blog, field, value)
+            blog.save()
+        Blog.refresh_post_stats()
+        rebuild_index(Post.objects.all())
+        bump_content_version()
+
+        return created, updated, deleted
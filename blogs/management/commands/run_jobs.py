@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from blogs.jobs import DatabaseQueue
+
+import threading
+import time
+
+
+class Command(BaseCommand):
+    help = "Runs the background jobs queued with JOB_BACKEND = 'database'"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1, help='Jobs run at the same time')
+        parser.add_argument('--once', action='store_true', help='Exit once no jobs are due (eg. from cron)')
+        parser.add_argument('--poll-interval', type=float, default=1.0, help='Seconds between checks for new jobs')
+        parser.add_argument('--stale-after', type=int, default=3600, help='Seconds after which a running job is assumed lost')
+
+    def handle(self, *args, **options):
+        self.queue = DatabaseQueue()
+        self.options = options
+
+        requeued = self.queue.requeue_stale(options['stale_after'])
+        if requeued:
+            self.stdout.write(f'Requeued {requeued} stale jobs')
+
+        threads = [threading.Thread(target=self.work, daemon=True) for _ in range(options['workers'])]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                thread.join()
+        except KeyboardInterrupt:
+            # Jobs interrupted mid-run are picked up again once they're stale
+            pass
+
+    def work(self):
+        while True:
+            try:
+                ran = self.queue.run_next()
+            finally:
+                close_old_connections()
+            if not ran:
+                if self.options['once']:
+                    return
+                time.sleep(self.options['poll_interval'])
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from blogs.cache import bump_content_version
+from blogs.helpers import excerpts
+from blogs.models import Blog, Post
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the stored excerpts, descriptions, word counts and reading times (eg. after changing unmark)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        for blog in Blog.objects.all():
+            blog.auto_description = excerpts(blog.content)['auto_description']
+            Blog.objects.filter(pk=blog.pk).update(auto_description=blog.auto_description)
+
+        fields = ['excerpt', 'auto_description', 'word_count', 'reading_time']
+        batch = []
+        updated = 0
+        for post in Post.objects.only('id', 'content').iterator(chunk_size=batch_size):
+            for field, value in excerpts(post.content).items():
+                setattr(post, field, value)
+            batch.append(post)
+            if len(batch) >= batch_size:
+                updated += Post.objects.bulk_update(batch, fields)
+                batch = []
+        updated += Post.objects.bulk_update(batch, fields)
+
+        bump_content_version()
+        self.stdout.write(self.style.SUCCESS(f'Updated excerpts for {updated} posts'))
@@ -1,6 +1,9 @@
+from django.conf import settings
+from django.core.cache import cache
 from django.db import connection
 from django.urls import resolve, Resolver404
 from django.http import JsonResponse
+from django.middleware.gzip import GZipMiddleware as DjangoGZipMiddleware
 from django.middleware.csrf import (
     CsrfViewMiddleware,
     REASON_NO_CSRF_COOKIE,
@@ -10,21 +13,128 @@ from django.middleware.csrf import (
 
 import time
 import threading
-from collections import defaultdict
+import queue
+from collections import defaultdict, deque
 from contextlib import contextmanager
-import redis
 import json
+import math
 import os
+import random
+
+from blogs.profiling import profile_stage, record_query, start_profile, stop_profile
+
+try:
+    import redis
+except ImportError:
+    redis = None
 
 
 # Replace the in-memory metrics with Redis connection handling
 redis_client = None
-if os.environ.get('REDISCLOUD_URL'):
+if redis and os.environ.get('REDISCLOUD_URL'):
     redis_client = redis.from_url(os.environ.get('REDISCLOUD_URL'))
 
-# Fallback to in-memory when Redis is not available
-request_metrics = defaultdict(list)
-    
+
+class MetricsRecorder:
+    """Collects request metrics off the request thread and flushes them to Redis in batches"""
+    key_prefix = 'request_metrics'
+
+    def __init__(self, max_metrics=500, batch_size=100):
+        self.max_metrics = max_metrics
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=10000)
+        # Fallback to in-memory when Redis is not available. Written by the worker while the dashboard reads it,
+        # so both go through _metrics_lock
+        self.local_metrics = defaultdict(lambda: deque(maxlen=self.max_metrics))
+        self._metrics_lock = threading.Lock()
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, metric_data):
+        self._ensure_worker()
+        try:
+            self.queue.put_nowait((endpoint, metric_data))
+        except queue.Full:
+            # Never block or slow down a request for the sake of metrics
+            pass
+
+    def _ensure_worker(self):
+        if self._worker is None or not self._worker.is_alive():
+            with self._lock:
+                if self._worker is None or not self._worker.is_alive():
+                    self._worker = threading.Thread(target=self._run, daemon=True)
+                    self._worker.start()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self.flush(batch)
+
+    def flush(self, batch):
+        if redis_client:
+            try:
+                # LPUSH + LTRIM keeps the newest entries per endpoint without a read-modify-write
+                pipe = redis_client.pipeline(transaction=False)
+                for endpoint, metric_data in batch:
+                    pipe.lpush(f"{self.key_prefix}:{endpoint}", json.dumps(metric_data))
+                for endpoint in {endpoint for endpoint, _ in batch}:
+                    pipe.ltrim(f"{self.key_prefix}:{endpoint}", 0, self.max_metrics - 1)
+                    pipe.sadd(f"{self.key_prefix}:endpoints", endpoint)
+                pipe.execute()
+                return
+            except redis.RedisError:
+                pass
+
+        with self._metrics_lock:
+            for endpoint, metric_data in batch:
+                self.local_metrics[endpoint].append(metric_data)
+
+    def get_metrics(self):
+        """Most recent metrics per endpoint"""
+        if redis_client:
+            try:
+                endpoints = sorted(e.decode() for e in redis_client.smembers(f"{self.key_prefix}:endpoints"))
+                pipe = redis_client.pipeline(transaction=False)
+                for endpoint in endpoints:
+                    pipe.lrange(f"{self.key_prefix}:{endpoint}", 0, self.max_metrics - 1)
+                return {
+                    endpoint: [json.loads(metric) for metric in metrics]
+                    for endpoint, metrics in zip(endpoints, pipe.execute())
+                }
+            except redis.RedisError:
+                pass
+
+        with self._metrics_lock:
+            return {endpoint: list(metrics) for endpoint, metrics in sorted(self.local_metrics.items())}
+
+    def get_summary(self):
+        """p50/p95/p99 of total, db and compute time per endpoint, in milliseconds"""
+        summary = []
+        for endpoint, metrics in self.get_metrics().items():
+            if not metrics:
+                continue
+            row = {'endpoint': endpoint, 'count': len(metrics)}
+            for field in ('total_time', 'db_time', 'compute_time'):
+                values = sorted(metric[field] * 1000 for metric in metrics)
+                for p in (50, 95, 99):
+                    row[f'{field}_p{p}'] = percentile(values, p)
+            summary.append(row)
+        return summary
+
+
+def percentile(sorted_values, p):
+    # Nearest-rank percentile
+    rank = math.ceil(p / 100 * len(sorted_values))
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+
+metrics_recorder = MetricsRecorder()
+
 
 # Thread-local storage for query times
 _local = threading.local()
@@ -47,7 +157,6 @@ class RequestPerformanceMiddleware:
     def __init__(self, get_response):
         self.get_response = get_response
         self.skip_methods = {'HEAD', 'OPTIONS'}
-        self.max_metrics = 50
 
     def get_pattern_name(self, request):
         if request.method in self.skip_methods:
@@ -82,43 +191,61 @@ class RequestPerformanceMiddleware:
             'timestamp': start_time
         }
 
-        if redis_client:
-            # Use Redis for storage
+        metrics_recorder.record(endpoint, metric_data)
+
+        return response
+
+
+class ProfilingMiddleware:
+    """Times the stages of a sample of requests and reports them in a Server-Timing header"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sample_rate = settings.PROFILING_SAMPLE_RATE
+
+    def __call__(self, request):
+        if random.random() >= self.sample_rate:
+            return self.get_response(request)
+
+        def execute_wrapper(execute, sql, params, many, context):
+            start = time.perf_counter()
             try:
-                redis_key = f"request_metrics:{endpoint}"
-                # Get existing metrics
-                metrics = redis_client.get(redis_key)
-                if metrics:
-                    metrics = json.loads(metrics)
-                else:
-                    metrics = []
-                
-                # Add new metric
-                metrics.append(metric_data)
-                # Keep only last 50 metrics
-                metrics = metrics[-self.max_metrics:]
-                
-                # Store back in Redis without TTL
-                redis_client.set(
-                    redis_key,
-                    json.dumps(metrics)
-                )
-            except redis.RedisError:
-                # Fallback to in-memory if Redis fails
-                metrics = request_metrics[endpoint]
-                metrics.append(metric_data)
-                if len(metrics) > self.max_metrics:
-                    del metrics[:-self.max_metrics]
-        else:
-            # Use in-memory storage
-            metrics = request_metrics[endpoint]
-            metrics.append(metric_data)
-            if len(metrics) > self.max_metrics:
-                del metrics[:-self.max_metrics]
+                return execute(sql, params, many, context)
+            finally:
+                record_query(sql, time.perf_counter() - start)
+
+        profile = start_profile(request.path)
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(execute_wrapper):
+                response = self.get_response(request)
+        finally:
+            profile.total_time = time.perf_counter() - start
+            stop_profile()
 
+        response['Server-Timing'] = profile.server_timing()
         return response
 
 
+# Already compressed formats, gzipping them only costs CPU
+COMPRESSED_CONTENT_TYPES = ('image/png', 'image/jpeg', 'image/gif', 'image/webp', 'image/avif', 'audio/', 'video/', 'font/woff', 'application/pdf', 'application/zip')
+
+
+class GZipMiddleware(DjangoGZipMiddleware):
+    """Django's GZipMiddleware, leaving compressed media and partial (Range) responses alone"""
+
+    def process_response(self, request, response):
+        if response.status_code == 206 or response.get('Content-Type', '').startswith(COMPRESSED_CONTENT_TYPES):
+            return response
+        return super().process_response(request, response)
+
+
+class ProfiledGZipMiddleware(GZipMiddleware):
+    def process_response(self, request, response):
+        with profile_stage('gzip'):
+            return super().process_response(request, response)
+
+
 # This is a workaround to handle custom domains from Django 5.0 there's an explicit CSRF_TRUSTED_ORIGINS list
 class AllowAnyDomainCsrfMiddleware(CsrfViewMiddleware):
     def process_view(self, request, callback, callback_args, callback_kwargs):
@@ -141,33 +268,94 @@ class AllowAnyDomainCsrfMiddleware(CsrfViewMiddleware):
                 return self._reject(request, reason)
 
    
+class MemoryRateLimitBackend:
+    """Per-process fixed-window counters, with idle keys evicted once per window"""
+
+    def __init__(self):
+        self.counts = {}
+        self.last_eviction = 0
+        self._lock = threading.Lock()
+
+    def incr(self, key, window):
+        current_time = time.time()
+        current_window = int(current_time // window)
+
+        with self._lock:
+            if current_time - self.last_eviction > window:
+                self.counts = {k: v for k, v in self.counts.items() if v[0] == current_window}
+                self.last_eviction = current_time
+
+            counted_window, count = self.counts.get(key, (current_window, 0))
+            if counted_window != current_window:
+                count = 0
+            self.counts[key] = (current_window, count + 1)
+
+        return count + 1
+
+
+class CacheRateLimitBackend:
+    """Counters in the default cache, shared between workers when it is Redis or the database cache"""
+
+    def incr(self, key, window):
+        cache_key = f"ratelimit:{key}:{int(time.time() // window)}"
+        if cache.add(cache_key, 1, window):
+            return 1
+        try:
+            return cache.incr(cache_key)
+        except ValueError:
+            # Expired between add and incr
+            cache.set(cache_key, 1, window)
+            return 1
+
+
+class RedisRateLimitBackend:
+    """Counters in Redis, shared between workers, falling back to per-process counters if Redis is down"""
+
+    def __init__(self):
+        self.fallback = MemoryRateLimitBackend()
+
+    def incr(self, key, window):
+        if not redis_client:
+            return self.fallback.incr(key, window)
+
+        redis_key = f"ratelimit:{key}:{int(time.time() // window)}"
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.incr(redis_key)
+            pipe.expire(redis_key, window)
+            count, _ = pipe.execute()
+            return count
+        except redis.RedisError:
+            return self.fallback.incr(key, window)
+
+
 class RateLimitMiddleware:
     RATE_LIMIT = 60  # max requests
     TIME_WINDOW = 60  # seconds
+    BACKENDS = {
+        'memory': MemoryRateLimitBackend,
+        'cache': CacheRateLimitBackend,
+        'redis': RedisRateLimitBackend,
+    }
 
     def __init__(self, get_response):
         self.get_response = get_response
-        self.ip_request_counts = defaultdict(list)
+        self.backend = self.BACKENDS[settings.RATE_LIMIT_BACKEND]()
+        self.exempt_views = set(settings.RATE_LIMIT_EXEMPT_VIEWS)
 
     def __call__(self, request):
-        # Skip rate limiting for ping and feed endpoints
-        if  'ping' in request.path or 'feed' in request.path:
-            return self.get_response(request)
+        return self.get_response(request)
 
-        client_ip_address = request.META.get('REMOTE_ADDR', '127.0.0.1')
-        current_time = time.time()
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # Skip rate limiting for exempt routes (eg. feeds, which readers poll), listed by view path or URL name
+        url_name = request.resolver_match.url_name if request.resolver_match else None
+        if f"{view_func.__module__}.{view_func.__name__}" in self.exempt_views or url_name in self.exempt_views:
+            return None
 
-        # Clean up old requests
-        self.ip_request_counts[client_ip_address] = [
-            timestamp for timestamp in self.ip_request_counts[client_ip_address]
-            if current_time - timestamp < self.TIME_WINDOW
-        ]
-        
-        # Record the current request
-        self.ip_request_counts[client_ip_address].append(current_time)
+        client_ip_address = request.META.get('REMOTE_ADDR', '127.0.0.1')
 
         # Check if the IP has exceeded the rate limit
-        if len(self.ip_request_counts[client_ip_address]) > self.RATE_LIMIT: 
+        if self.backend.incr(client_ip_address, self.TIME_WINDOW) > self.RATE_LIMIT:
             full_path = request.build_absolute_uri()
             print(f"Rate limit: Exceeded for {client_ip_address} at {full_path}")
             print(f"Rate limit: User agent {request.META.get('HTTP_USER_AGENT')}")
@@ -176,7 +364,7 @@ class RateLimitMiddleware:
                 status=429
             )
 
-        return self.get_response(request)
+        return None
 
 
 # Prevent clickjacking on root domiains
@@ -0,0 +1,37 @@
+# Generated by Django 4.2.23 on 2026-10-18 04:04
+
+from django.db import migrations, models
+import django.db.models.deletion
+import json
+
+
+def index_existing_tags(apps, schema_editor):
+    Post = apps.get_model('blogs', 'Post')
+    PostTag = apps.get_model('blogs', 'PostTag')
+    post_tags = []
+    for post_id, all_tags in Post.objects.values_list('id', 'all_tags').iterator():
+        for tag in set(json.loads(all_tags or '[]')):
+            post_tags.append(PostTag(post_id=post_id, name=tag))
+    PostTag.objects.bulk_create(post_tags, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blogs', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PostTag',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(db_index=True, max_length=200)),
+                ('post', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tag_index', to='blogs.post')),
+            ],
+            options={
+                'unique_together': {('post', 'name')},
+            },
+        ),
+        migrations.RunPython(index_existing_tags, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,101 @@
+# Generated by Django 4.2.23 on 2026-10-18 04:13
+
+from django.db import migrations, models
+
+import re
+
+
+# blogs.helpers.excerpts as it was when this migration was written, frozen here so later changes to it can't
+# change what this migration does
+
+UNMARK_PATTERN = re.compile(r'(?=[\s#*>`!\[_~+|:\d-])(?:' + '|'.join([
+    r'^\s{0,3}#{1,6}\s+.*$',
+    r'^\s{0,3}[-*]{3,}\s*$',
+    r'^\s{0,3}>\s+.*$',
+    r'(?s:```.*?```)',
+    r'`[^`]+`',
+    r'!\[.*?\]\(.*?\)',
+    r'\[.*?\]\(.*?\)',
+    r'(?P<strong>\*\*|__).*?(?P=strong)',
+    r'(?P<em>\*|_).*?(?P=em)',
+    r'~~.*?~~',
+    r'^\s{0,3}[-*+]\s+.*$',
+    r'^\s{0,3}\d+\.\s+.*$',
+    r'^\s*\|.*?\|\s*$',
+    r'^\s*[:-]{3,}\s*$',
+]) + ')', flags=re.MULTILINE)
+
+FENCED_CODE_PATTERN = re.compile(r'```.*?```', flags=re.DOTALL)
+WORD_PATTERN = re.compile(r'\w+')
+
+WORDS_PER_MINUTE = 200
+
+
+def truncate(text, length):
+    return text if len(text) <= length else text[:length] + '...'
+
+
+def excerpts(content):
+    text = ' '.join(UNMARK_PATTERN.sub('', content).split())
+    word_count = len(WORD_PATTERN.findall(FENCED_CODE_PATTERN.sub('', content)))
+    return {
+        'excerpt': truncate(text, 400),
+        'auto_description': truncate(text, 157),
+        'word_count': word_count,
+        'reading_time': -(-word_count // WORDS_PER_MINUTE),
+    }
+
+
+def compute_excerpts(apps, schema_editor):
+    Blog = apps.get_model('blogs', 'Blog')
+    Post = apps.get_model('blogs', 'Post')
+    for blog in Blog.objects.all():
+        blog.auto_description = excerpts(blog.content)['auto_description']
+        blog.save(update_fields=['auto_description'])
+
+    fields = ['excerpt', 'auto_description', 'word_count', 'reading_time']
+    batch = []
+    for post in Post.objects.only('id', 'content').iterator(chunk_size=500):
+        for field, value in excerpts(post.content).items():
+            setattr(post, field, value)
+        batch.append(post)
+        if len(batch) >= 500:
+            Post.objects.bulk_update(batch, fields)
+            batch = []
+    Post.objects.bulk_update(batch, fields)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blogs', '0002_post_tag_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blog',
+            name='auto_description',
+            field=models.CharField(blank=True, max_length=200),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='auto_description',
+            field=models.CharField(blank=True, max_length=200),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='excerpt',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='reading_time',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='word_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(compute_excerpts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 4.2.23 on 2026-10-18 04:31
+
+from django.db import migrations, models
+
+
+def name_existing_media(apps, schema_editor):
+    Media = apps.get_model('blogs', 'Media')
+    taken = set()
+    for media in Media.objects.order_by('created_at', 'id').iterator():
+        name = media.url.split('/')[-1]
+        if name in taken:
+            name = f'{media.id}-{name}'
+        taken.add(name)
+        media.name = name
+        media.save(update_fields=['name'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blogs', '0004_media_variants'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='media',
+            name='name',
+            field=models.CharField(default='', max_length=255),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='media',
+            name='sha256',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+        migrations.RunPython(name_existing_media, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='media',
+            name='name',
+            field=models.CharField(max_length=255, unique=True),
+        ),
+    ]
@@ -0,0 +1,89 @@
+# Generated by Django 4.2.23 on 2026-10-18 11:40
+
+from django.db import migrations
+
+import json
+import re
+
+
+# The index table and how post text was indexed when this migration was written, frozen here so later changes to
+# blogs.search can't change what this migration does
+
+SEARCH_TABLE = 'blogs_post_search'
+
+PLAIN_TEXT_SUBSTITUTIONS = [(re.compile(pattern, flags=re.MULTILINE), replacement) for pattern, replacement in [
+    (r'^\s{0,3}(?:```|~~~).*$', ''),
+    (r'<[^>\n]+>', ' '),
+    (r'^\s{0,3}(?:[-*_]\s*){3,}$', ''),
+    (r'^\s*\|?(?:\s*:?-{3,}:?\s*\|?)+\s*$', ''),
+    (r'^\s{0,3}(?:#{1,6}\s+|(?:>\s?)+|[-*+]\s+|\d+[.)]\s+)', ''),
+    (r'!?\[([^\]]*)\]\([^)]*\)', r'\1'),
+    (r'(`+)(.+?)\1', r'\2'),
+    (r'(\*\*|~~|\*)(?=\S)(.+?)(?<=\S)\1', r'\2'),
+    (r'(?<!\w)(__|_)(?=\S)(.+?)(?<=\S)\1(?!\w)', r'\2'),
+    (r'\|', ' '),
+]]
+CONTROL_CHARACTER_PATTERN = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+def plain_text(content):
+    for pattern, replacement in PLAIN_TEXT_SUBSTITUTIONS:
+        content = pattern.sub(replacement, content)
+    return CONTROL_CHARACTER_PATTERN.sub('', ' '.join(content.split()))
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5(title, tags, body, tokenize='porter unicode61')")
+        id_column = 'rowid'
+    elif vendor == 'postgresql':
+        schema_editor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {SEARCH_TABLE} (
+                post_id bigint PRIMARY KEY REFERENCES blogs_post (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED,
+                title text NOT NULL,
+                tags text NOT NULL,
+                body text NOT NULL,
+                document tsvector GENERATED ALWAYS AS (
+                    setweight(to_tsvector('english', title), 'A') ||
+                    setweight(to_tsvector('english', tags), 'B') ||
+                    setweight(to_tsvector('english', body), 'C')
+                ) STORED
+            )""")
+        schema_editor.execute(f'CREATE INDEX IF NOT EXISTS {SEARCH_TABLE}_document ON {SEARCH_TABLE} USING gin (document)')
+        id_column = 'post_id'
+    else:
+        return
+
+    Post = apps.get_model('blogs', 'Post')
+    rows = []
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {SEARCH_TABLE}')
+        for post_id, title, content, all_tags in Post.objects.values_list('id', 'title', 'content', 'all_tags').iterator(chunk_size=500):
+            rows.append((
+                post_id,
+                CONTROL_CHARACTER_PATTERN.sub('', title or ''),
+                ' '.join(json.loads(all_tags or '[]')),
+                plain_text(content or ''),
+            ))
+            if len(rows) >= 500:
+                cursor.executemany(f'INSERT INTO {SEARCH_TABLE} ({id_column}, title, tags, body) VALUES (%s, %s, %s, %s)', rows)
+                rows = []
+        if rows:
+            cursor.executemany(f'INSERT INTO {SEARCH_TABLE} ({id_column}, title, tags, body) VALUES (%s, %s, %s, %s)', rows)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor in ('sqlite', 'postgresql'):
+        schema_editor.execute(f'DROP TABLE IF EXISTS {SEARCH_TABLE}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blogs', '0006_job'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
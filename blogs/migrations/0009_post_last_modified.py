@@ -0,0 +1,18 @@
+# Generated by Django 4.2.23 on 2026-10-18 04:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blogs', '0008_content_version'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='post',
+            name='last_modified',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+    ]
@@ -10,6 +10,9 @@ import string
 import hashlib
 import requests
 
+from blogs.cache import bump_content_version
+from blogs.jobs import enqueue
+
 
 class Blog(models.Model):
     # Single blog instance - no user relationship needed
@@ -31,6 +34,7 @@ class Blog(models.Model):
     header_directive = models.TextField(blank=True)
     footer_directive = models.TextField(blank=True)
     all_tags = models.TextField(default='[]')
+    auto_description = models.CharField(max_length=200, blank=True)
 
     # Styling and customization
     custom_styles = models.TextField(blank=True)
@@ -57,10 +61,14 @@ class Blog(models.Model):
     def contains_code(self):
         return "```" in self.content
 
+    @property
+    def description(self):
+        return self.meta_description or self.auto_description
+
     @property
     def is_empty(self):
         content_length = len(self.content) if self.content is not None else 0
-        return content_length < 20 and self.posts.count() == 0 and self.custom_styles == ""
+        return content_length < 20 and Post.objects.count() == 0 and self.custom_styles == ""
     
     @property
     def tags(self):
@@ -69,11 +77,18 @@ class Blog(models.Model):
     def update_all_tags(self):
         all_tags = []
         if self.pk:
-            for post in Post.objects.filter(blog=self, publish=True, is_page=False, published_date__lt=timezone.now()):
-                all_tags.extend(json.loads(post.all_tags))
-                all_tags = list(set(all_tags))
+            all_tags = PostTag.published_tags()
         self.all_tags = json.dumps(all_tags)
 
+    @staticmethod
+    def latest_published_date():
+        return Post.objects.filter(publish=True, published_date__lt=timezone.now()).order_by('-published_date').values_list('published_date', flat=True).first()
+
+    @classmethod
+    def refresh_post_stats(cls):
+        """Update the denormalised tags and last posted date without a full save"""
+        cls.objects.update(all_tags=json.dumps(PostTag.published_tags()), last_posted=cls.latest_published_date())
+
     def save(self, *args, **kwargs):
         # Handle all tags
         self.update_all_tags()
@@ -112,10 +127,22 @@ a:hover {
 
         if self.pk:
             # Update last posted
-            self.last_posted = self.posts.filter(publish=True, published_date__lt=timezone.now()).order_by('-published_date').values_list('published_date', flat=True).first()
+            self.last_posted = self.latest_published_date()
+
+        self.update_excerpts()
 
         # Save the blog
         super(Blog, self).save(*args, **kwargs)
+        bump_content_version()
+
+    def delete(self, *args, **kwargs):
+        deleted = super(Blog, self).delete(*args, **kwargs)
+        bump_content_version()
+        return deleted
+
+    def update_excerpts(self):
+        from blogs.helpers import excerpts
+        self.auto_description = excerpts(self.content)['auto_description']
 
     @property
     def useful_domain(self):
@@ -143,7 +170,8 @@ class Post(models.Model):
     slug = models.CharField(max_length=200, db_index=True)
     alias = models.CharField(max_length=200, blank=True, db_index=True)
     published_date = models.DateTimeField(blank=True, db_index=True)
-    last_modified = models.DateTimeField(auto_now_add=True, blank=True)
+    # Indexed for incremental backups, which pick up the posts modified since the last one
+    last_modified = models.DateTimeField(auto_now=True, blank=True, db_index=True)
     all_tags = models.TextField(default='[]')
     publish = models.BooleanField(default=True, db_index=True)
     is_page = models.BooleanField(default=False, db_index=True)
@@ -154,10 +182,20 @@ class Post(models.Model):
     lang = models.CharField(max_length=10, blank=True, db_index=True)
     class_name = models.CharField(max_length=200, blank=True)
 
+    # Derived from content on save, see update_excerpts
+    excerpt = models.TextField(blank=True)
+    auto_description = models.CharField(max_length=200, blank=True)
+    word_count = models.PositiveIntegerField(default=0)
+    reading_time = models.PositiveIntegerField(default=0)  # minutes
+
     @property
     def contains_code(self):
         return "```" in self.content
 
+    @property
+    def description(self):
+        return self.meta_description or self.auto_description
+
     @property
     def tags(self):
         return sorted(json.loads(self.all_tags))
@@ -173,25 +211,73 @@ class Post(models.Model):
 
         # Create unique random identifier
         if not self.uid:
-            allowed_chars = string.ascii_letters.replace('O', '').replace('l', '')
-            self.uid = ''.join(random.choice(allowed_chars) for _ in range(20))
+            self.uid = self.generate_uid()
+
+        self.update_excerpts()
 
         # Save the post
         super(Post, self).save(*args, **kwargs)
 
-        # Update blog tags
-        try:
-            from .models import Blog
-            blog = Blog.objects.first()
-            if blog:
-                blog.save()
-        except:
-            pass  # Handle case where blog doesn't exist yet
+        # Update blog tags, the blog wide tags and last posted date follow in the background
+        self.update_tag_index()
+        self.update_search_index()
+        bump_content_version()
+        enqueue('refresh_post_stats')
+
+    def delete(self, *args, **kwargs):
+        from blogs.search import unindex_post
+        unindex_post(self.pk)
+        deleted = super(Post, self).delete(*args, **kwargs)
+        bump_content_version()
+        enqueue('refresh_post_stats')
+        return deleted
+
+    @staticmethod
+    def generate_uid():
+        allowed_chars = string.ascii_letters.replace('O', '').replace('l', '')
+        return ''.join(random.choice(allowed_chars) for _ in range(20))
+
+    def update_excerpts(self):
+        from blogs.helpers import excerpts
+        for field, value in excerpts(self.content).items():
+            setattr(self, field, value)
+
+    def update_search_index(self):
+        from blogs.search import index_post
+        index_post(self)
+
+    def update_tag_index(self):
+        # Only touch the rows for tags that were added or removed
+        tags = set(self.tags)
+        indexed_tags = set(self.tag_index.values_list('name', flat=True))
+        if tags != indexed_tags:
+            self.tag_index.filter(name__in=indexed_tags - tags).delete()
+            PostTag.objects.bulk_create([PostTag(post=self, name=tag) for tag in tags - indexed_tags])
 
     def __str__(self):
         return self.title
 
 
+class PostTag(models.Model):
+    # Normalised copy of Post.all_tags, kept in sync by Post.save
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='tag_index')
+    name = models.CharField(max_length=200, db_index=True)
+
+    class Meta:
+        unique_together = ('post', 'name')
+
+    @staticmethod
+    def published_tags():
+        return list(PostTag.objects.filter(
+            post__publish=True,
+            post__is_page=False,
+            post__published_date__lt=timezone.now()
+        ).values_list('name', flat=True).distinct())
+
+    def __str__(self):
+        return self.name
+
+
 class Stylesheet(models.Model):
     title = models.CharField(max_length=100)
     identifier = models.SlugField(max_length=100, unique=True)
@@ -199,20 +285,95 @@ class Stylesheet(models.Model):
     external = models.BooleanField(default=False)
     image = models.CharField(max_length=100, blank=True)
 
+    def save(self, *args, **kwargs):
+        super(Stylesheet, self).save(*args, **kwargs)
+        bump_content_version()
+
     def __str__(self):
         return self.title
 
 
+MEDIA_BUCKET = 'bear-images'
+MEDIA_URL_PREFIX = f'https://{MEDIA_BUCKET}.sfo2.cdn.digitaloceanspaces.com/'
+
+
 class Media(models.Model):
     url = models.URLField(max_length=500)
+    # File name within the blog's media, and the hash of the uploaded file used to deduplicate uploads
+    name = models.CharField(max_length=255, unique=True)
+    sha256 = models.CharField(max_length=64, blank=True, db_index=True)
     created_at = models.DateTimeField(default=timezone.now)
 
+    # Images only, variants is a list of {"url", "width", "content_type"} resized copies
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    variants = models.TextField(default='[]')
+
     class Meta:
         ordering = ['-created_at']
 
     @property
-    def name(self):
-        return self.url.split('/')[-1]
+    def image_variants(self):
+        return json.loads(self.variants)
+
+    @staticmethod
+    def allocate_name(stem, extension):
+        """First free "<stem>[-n].<extension>" name, found with a single indexed prefix lookup"""
+        # A range rather than startswith, which is a LIKE the name index can't serve. order_by() drops the default
+        # ordering, which would otherwise sort the matches
+        names = Media.objects.filter(name__gte=stem, name__lt=stem + '\uffff').order_by().values_list('name', flat=True)
+        taken_stems = {name.rsplit('.', 1)[0] for name in names}
+        count = 0
+        candidate = stem
+        while candidate in taken_stems:
+            count += 1
+            candidate = f'{stem}-{count}'
+        return f'{candidate}.{extension}'
+
+    @staticmethod
+    def for_image_urls(urls):
+        """The uploaded images behind URLs used in a post by URL, for those that are ours"""
+        urls = [url for url in urls if url.startswith(MEDIA_URL_PREFIX)]
+        if not urls:
+            return {}
+        return {media.url: media for media in Media.objects.filter(url__in=urls).only('url', 'width', 'height', 'variants')}
 
     def __str__(self):
         return f"{self.url} - {self.created_at}"
+
+
+class ContentVersion(models.Model):
+    # Single row holding the version stamp of the blog content, see blogs/cache.py
+    SINGLETON_ID = 1
+
+    version = models.CharField(max_length=32)
+    # When the next scheduled post goes live, and the version with it
+    expires_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return self.version
+
+
+class Job(models.Model):
+    # Background work queued with JOB_BACKEND = 'database', see blogs/jobs.py
+    PENDING = 'pending'
+    RUNNING = 'running'
+    FAILED = 'failed'
+
+    name = models.CharField(max_length=100)
+    arguments = models.TextField(default='[[], {}]')
+    # Set for coalesced jobs, only one pending job may share a key
+    key = models.CharField(max_length=500, blank=True, db_index=True)
+    status = models.CharField(max_length=10, default=PENDING, choices=((PENDING, 'Pending'), (RUNNING, 'Running'), (FAILED, 'Failed')))
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    run_at = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['run_at', 'id']
+        indexes = [models.Index(fields=['status', 'run_at'])]
+
+    def __str__(self):
+        return f"{self.name} - {self.status}"
@@ -0,0 +1,119 @@
+from django.template.backends.django import DjangoTemplates
+
+from collections import Counter, deque
+from contextlib import contextmanager
+import threading
+import time
+
+
+# Profile of the request being handled by this thread, if it was sampled
+_local = threading.local()
+
+# Most recent profiles handled by this process, for the dashboard report
+recent_profiles = deque(maxlen=200)
+
+
+class Profile:
+    def __init__(self, path):
+        self.path = path
+        self.timestamp = time.time()
+        self.stages = Counter()
+        self.queries = Counter()
+        self.total_time = 0.0
+        self._active = Counter()
+
+    @property
+    def query_count(self):
+        return sum(self.queries.values())
+
+    @property
+    def duplicate_queries(self):
+        return {sql: count for sql, count in self.queries.items() if count > 1}
+
+    def server_timing(self):
+        metrics = [f'{name};dur={duration * 1000:.2f}' for name, duration in self.stages.items()]
+        metrics.append(f'total;dur={self.total_time * 1000:.2f};desc="{self.query_count} queries, {len(self.duplicate_queries)} duplicated"')
+        return ', '.join(metrics)
+
+
+def start_profile(path):
+    _local.profile = Profile(path)
+    return _local.profile
+
+
+def stop_profile():
+    profile = getattr(_local, 'profile', None)
+    _local.profile = None
+    if profile is not None:
+        recent_profiles.append(profile)
+    return profile
+
+
+@contextmanager
+def profile_stage(name):
+    """Time a named stage of the current request. Nested stages are inclusive, re-entering a stage is not double counted"""
+    profile = getattr(_local, 'profile', None)
+    if profile is None or profile._active[name]:
+        yield
+        return
+
+    profile._active[name] += 1
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.stages[name] += time.perf_counter() - start
+        profile._active[name] -= 1
+
+
+def record_query(sql, duration):
+    profile = getattr(_local, 'profile', None)
+    if profile is not None:
+        profile.queries[sql] += 1
+        profile.stages['db'] += duration
+
+
+class ProfiledTemplate:
+    def __init__(self, template):
+        self.template = template
+
+    def __getattr__(self, name):
+        return getattr(self.template, name)
+
+    def render(self, context=None, request=None):
+        with profile_stage('template'):
+            return self.template.render(context, request)
+
+
+class ProfiledDjangoTemplates(DjangoTemplates):
+    """The Django template backend, timing template rendering for sampled requests"""
+
+    def from_string(self, template_code):
+        return ProfiledTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return ProfiledTemplate(super().get_template(template_name))
+
+
+def summarise_profiles():
+    """Mean stage timings (ms), query counts and duplicated queries per path"""
+    by_path = {}
+    for profile in list(recent_profiles):
+        by_path.setdefault(profile.path, []).append(profile)
+
+    summary = []
+    for path, profiles in sorted(by_path.items()):
+        stages = Counter()
+        duplicates = Counter()
+        for profile in profiles:
+            stages.update(profile.stages)
+            duplicates.update(profile.duplicate_queries)
+        summary.append({
+            'path': path,
+            'count': len(profiles),
+            'total_time': sum(p.total_time for p in profiles) / len(profiles) * 1000,
+            'stages': {name: duration / len(profiles) * 1000 for name, duration in sorted(stages.items())},
+            'query_count': sum(p.query_count for p in profiles) / len(profiles),
+            'duplicate_queries': duplicates.most_common(5),
+        })
+    return summary
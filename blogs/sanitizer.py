@@ -0,0 +1,198 @@
+from html import escape
+from html.parser import HTMLParser
+from urllib.parse import urlsplit
+import hashlib
+import re
+
+from blogs.cache import LRUCache
+
+
+HOST_WHITELIST = {
+    'www.youtube.com',
+    'www.youtube-nocookie.com',
+    'www.slideshare.net',
+    'player.vimeo.com',
+    'w.soundcloud.com',
+    'www.google.com',
+    'codepen.io',
+    'stackblitz.com',
+    'onedrive.live.com',
+    'docs.google.com',
+    'bandcamp.com',
+    'embed.music.apple.com',
+    'drive.google.com',
+    'share.transistor.fm',
+    'share.descript.com',
+    'mrkennedy.ca',
+    'open.spotify.com',
+    'umap.openstreetmap.fr',
+    'music.163.com',
+    'sheevcharan.substack.com',
+    'guestbooks.meadow.cafe',
+    'supercut.video',
+    'listenbrainz.org',
+    'api.listenbrainz.org',
+    'archive.org',
+}
+
+# Removed along with everything inside them
+REMOVED_ELEMENTS = {'script'}
+
+# Removed, but their contents are kept
+STRIPPED_TAGS = {'object', 'embed', 'form', 'input', 'button'}
+
+# Browsers ignore whitespace and control characters inside a URL scheme ("java\tscript:")
+IGNORED_URL_CHARACTERS = re.compile(r'[\x00-\x20]+')
+UNSAFE_URL_SCHEMES = ('javascript:', 'vbscript:')
+
+# Browsers read the contents of these as text up to their end tag, never as markup. Their text is passed through
+# with "<" escaped, so nothing inside can end the element early and smuggle markup out
+ESCAPED_TEXT_ELEMENTS = {'noscript', 'iframe', 'noembed', 'noframes', 'textarea', 'title', 'xmp'}
+
+# Inside SVG and MathML browsers parse the contents of <style> and the elements above as markup, so there they're
+# sanitized like any other markup
+FOREIGN_ELEMENTS = {'svg', 'math'}
+
+# Anything in a stylesheet that a browser could take for its end tag
+STYLE_END_PATTERN = re.compile(r'</(?=style)', flags=re.IGNORECASE)
+
+sanitized_cache = LRUCache(max_entries=1000, max_size=16 * 1024 * 1024)
+
+
+def iframe_allowed(src):
+    try:
+        url = urlsplit(src.strip())
+    except ValueError:
+        return False
+    if url.scheme not in ('http', 'https', ''):
+        return False
+
+    # Whitelisted hosts and their subdomains
+    labels = (url.hostname or '').split('.')
+    return any('.'.join(labels[i:]) in HOST_WHITELIST for i in range(len(labels) - 1))
+
+
+def unsafe_attribute(name, value):
+    if name.startswith('on') or name == 'srcdoc':
+        return True
+    return IGNORED_URL_CHARACTERS.sub('', value or '').lower().startswith(UNSAFE_URL_SCHEMES)
+
+
+class Sanitizer(HTMLParser):
+    """
+    Removes scripts, event handlers, javascript: URLs, forms and embeds, comments, and iframes from unknown hosts
+    in one pass. Only a top level <style> keeps its contents as raw text, the contents of other raw text elements
+    (<noscript>, <textarea>, <xmp>...) are escaped as text
+    """
+
+    # Raw text elements are switched into by handle_tag, depending on where they are
+    CDATA_CONTENT_ELEMENTS = ()
+
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.output = []
+        self.removing = None  # (tag, depth) of the element being dropped
+        self.raw_text = None  # style or escaped text element whose contents are being read as text
+        self.foreign = []  # open svg and math elements
+
+    def handle_starttag(self, tag, attrs):
+        self.handle_tag(tag, attrs, self.get_starttag_text(), closed=False)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_tag(tag, attrs, self.get_starttag_text(), closed=True)
+
+    def handle_tag(self, tag, attrs, text, closed):
+        if self.removing:
+            removed_tag, depth = self.removing
+            if tag == removed_tag and not closed:
+                self.removing = (removed_tag, depth + 1)
+            return
+
+        if tag in REMOVED_ELEMENTS or (tag == 'iframe' and not iframe_allowed(dict(attrs).get('src') or '')):
+            if not closed:
+                self.removing = (tag, 1)
+                if tag == 'script' or (tag in ESCAPED_TEXT_ELEMENTS and not self.foreign):
+                    self.set_cdata_mode(tag)
+            return
+        if tag in STRIPPED_TAGS:
+            return
+
+        safe_attrs = [(name, value) for name, value in attrs if not unsafe_attribute(name, value)]
+        if len(safe_attrs) != len(attrs):
+            # Only rebuild tags that changed so everything else is passed through untouched
+            rendered_attrs = ''.join(f' {name}' if value is None else f' {name}="{escape(value)}"' for name, value in safe_attrs)
+            text = f"<{tag}{rendered_attrs}{' /' if closed else ''}>"
+
+        self.output.append(text)
+        if closed:
+            return
+
+        if tag in FOREIGN_ELEMENTS:
+            self.foreign.append(tag)
+        elif (tag == 'style' or tag in ESCAPED_TEXT_ELEMENTS) and not self.foreign:
+            self.raw_text = tag
+            self.set_cdata_mode(tag)
+
+    def handle_endtag(self, tag):
+        if self.removing:
+            removed_tag, depth = self.removing
+            if tag == removed_tag:
+                self.removing = (removed_tag, depth - 1) if depth > 1 else None
+            return
+        if tag in STRIPPED_TAGS:
+            return
+
+        if tag == self.raw_text:
+            self.raw_text = None
+        if tag in self.foreign:
+            # Closes anything opened inside it too
+            del self.foreign[len(self.foreign) - 1 - self.foreign[::-1].index(tag):]
+        self.output.append(f'</{tag}>')
+
+    def handle_data(self, data):
+        if self.removing:
+            return
+        if self.raw_text == 'style':
+            self.output.append(STYLE_END_PATTERN.sub(r'<\\/', data))
+        else:
+            # A stray "<" here is text (or a tag left unfinished at the end), never markup
+            self.output.append(data.replace('<', '&lt;'))
+
+    def handle_entityref(self, name):
+        if not self.removing:
+            self.output.append(f'&{name};')
+
+    def handle_charref(self, name):
+        if not self.removing:
+            self.output.append(f'&#{name};')
+
+    # Comments and declarations are dropped, browsers end them in places a parser can disagree on ("<!-->")
+
+    def handle_comment(self, data):
+        pass
+
+    def handle_decl(self, decl):
+        pass
+
+    def unknown_decl(self, data):
+        pass
+
+
+def sanitize_markup(markup):
+    sanitizer = Sanitizer()
+    sanitizer.feed(markup)
+    sanitizer.close()
+    if sanitizer.raw_text:
+        # Otherwise it would swallow the rest of the page
+        sanitizer.output.append(f'</{sanitizer.raw_text}>')
+    return ''.join(sanitizer.output)
+
+
+def sanitize(markup):
+    """Sanitized markup, cached by the hash of the input"""
+    key = hashlib.sha1(markup.encode()).hexdigest()
+    sanitized = sanitized_cache.get(key)
+    if sanitized is None:
+        sanitized = sanitize_markup(markup)
+        sanitized_cache.set(key, sanitized)
+    return sanitized
@@ -0,0 +1,195 @@
+from django.db import OperationalError, ProgrammingError, connection
+from django.db.models import Q, Value
+from django.utils import timezone
+from django.utils.html import escape
+
+import json
+import re
+
+from blogs.helpers import plain_text
+from blogs.models import Post
+
+
+# Plain text of every post in a full-text index: an FTS5 table on SQLite or a tsvector table on Postgres.
+# The table lives outside the ORM, kept in sync by Post.save/delete and rebuilt after bulk changes.
+# Other databases fall back to a LIKE scan
+
+SEARCH_TABLE = 'blogs_post_search'
+SEARCH_PAGE_SIZE = 20
+
+# Marks matches in snippets. Control characters can't be in the indexed text, so escaping the snippet can't touch them
+MATCH_START = '\x02'
+MATCH_END = '\x03'
+
+SEARCH_TERM_PATTERN = re.compile(r'\w+')
+CONTROL_CHARACTER_PATTERN = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+# Relative weight of matches in the title, the tags and the body
+SQLITE_BM25_WEIGHTS = (10.0, 5.0, 1.0)
+
+
+def search_backend():
+    return {'sqlite': 'fts5', 'postgresql': 'tsvector'}.get(connection.vendor)
+
+
+def create_index():
+    # Matches the table created by migration 0007
+    backend = search_backend()
+    execute = connection.cursor().execute
+    if backend == 'fts5':
+        execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5(title, tags, body, tokenize='porter unicode61')")
+    elif backend == 'tsvector':
+        execute(f"""
+            CREATE TABLE IF NOT EXISTS {SEARCH_TABLE} (
+                post_id bigint PRIMARY KEY REFERENCES blogs_post (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED,
+                title text NOT NULL,
+                tags text NOT NULL,
+                body text NOT NULL,
+                document tsvector GENERATED ALWAYS AS (
+                    setweight(to_tsvector('english', title), 'A') ||
+                    setweight(to_tsvector('english', tags), 'B') ||
+                    setweight(to_tsvector('english', body), 'C')
+                ) STORED
+            )""")
+        execute(f'CREATE INDEX IF NOT EXISTS {SEARCH_TABLE}_document ON {SEARCH_TABLE} USING gin (document)')
+
+
+def id_column():
+    return 'rowid' if search_backend() == 'fts5' else 'post_id'
+
+
+def index_row(post_id, title, content, all_tags):
+    # Control characters are dropped so they can't be mistaken for match markers
+    body = CONTROL_CHARACTER_PATTERN.sub('', ' '.join(plain_text(content or '').split()))
+    return post_id, CONTROL_CHARACTER_PATTERN.sub('', title or ''), ' '.join(json.loads(all_tags or '[]')), body
+
+
+def index_posts(rows):
+    """Replaces the index entries of (id, title, content, all_tags) rows"""
+    if not search_backend():
+        return
+    rows = [index_row(*row) for row in rows]
+    if not rows:
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany(f'DELETE FROM {SEARCH_TABLE} WHERE {id_column()} = %s', [(row[0],) for row in rows])
+        cursor.executemany(f'INSERT INTO {SEARCH_TABLE} ({id_column()}, title, tags, body) VALUES (%s, %s, %s, %s)', rows)
+
+
+def index_post(post):
+    index_posts([(post.pk, post.title, post.content, post.all_tags)])
+
+
+def unindex_post(post_id):
+    if search_backend():
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {SEARCH_TABLE} WHERE {id_column()} = %s', [post_id])
+
+
+def rebuild_index(posts, batch_size=500):
+    """Reindexes every post in the queryset"""
+    if not search_backend():
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {SEARCH_TABLE}')
+    count = 0
+    batch = []
+    for row in posts.values_list('id', 'title', 'content', 'all_tags').iterator(chunk_size=batch_size):
+        batch.append(row)
+        if len(batch) >= batch_size:
+            index_posts(batch)
+            count += len(batch)
+            batch = []
+    index_posts(batch)
+    return count + len(batch)
+
+
+def fts5_query(query):
+    # Each word is quoted so user input can't use (or break) the FTS5 query syntax. The last one matches as a prefix
+    terms = [f'"{term}"' for term in SEARCH_TERM_PATTERN.findall(query)]
+    if terms:
+        terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def highlight(snippet):
+    return escape(snippet).replace(MATCH_START, '<mark>').replace(MATCH_END, '</mark>')
+
+
+def published_posts(now):
+    """Posts shown in search results, for both the index queries and the LIKE fallback"""
+    return Post.objects.filter(publish=True, is_page=False, published_date__lte=now)
+
+
+def index_missing(error):
+    # SQLite says "no such table: blogs_post_search", Postgres 'relation "blogs_post_search" does not exist'
+    message = str(error)
+    return SEARCH_TABLE in message and ('no such table' in message or 'does not exist' in message)
+
+
+def matching_post_ids(query, published_only=True, limit=None, offset=0):
+    """(post id, snippet) of posts matching the query, best match first"""
+    backend = search_backend()
+    if not query.strip():
+        return []
+    posts = published_posts(timezone.now()) if published_only else Post.objects.all()
+
+    if backend == 'fts5':
+        match = fts5_query(query)
+        if not match:
+            return []
+        weights = ', '.join(str(weight) for weight in SQLITE_BM25_WEIGHTS)
+        sql = f"""
+            SELECT {SEARCH_TABLE}.rowid, snippet({SEARCH_TABLE}, 2, %s, %s, '…', 24)
+            FROM {SEARCH_TABLE} JOIN blogs_post ON blogs_post.id = {SEARCH_TABLE}.rowid
+            WHERE {SEARCH_TABLE} MATCH %s {{published}}
+            ORDER BY bm25({SEARCH_TABLE}, {weights})"""
+        params = [MATCH_START, MATCH_END, match]
+    elif backend == 'tsvector':
+        sql = f"""
+            SELECT {SEARCH_TABLE}.post_id, ts_headline('english', {SEARCH_TABLE}.body, query, %s)
+            FROM {SEARCH_TABLE} JOIN blogs_post ON blogs_post.id = {SEARCH_TABLE}.post_id,
+                websearch_to_tsquery('english', %s) query
+            WHERE {SEARCH_TABLE}.document @@ query {{published}}
+            ORDER BY ts_rank_cd({SEARCH_TABLE}.document, query) DESC"""
+        params = [f'StartSel={MATCH_START}, StopSel={MATCH_END}, MaxWords=24, MinWords=12, MaxFragments=2', query]
+    else:
+        # No snippet, there's nothing to mark matches in
+        posts = posts.filter(Q(title__icontains=query) | Q(content__icontains=query)).order_by('-published_date')
+        posts = posts.annotate(snippet=Value('')).values_list('id', 'snippet')
+        return list(posts[offset:offset + limit] if limit else posts[offset:])
+
+    published = ''
+    if published_only:
+        published_sql, published_params = posts.values('id').query.sql_with_params()
+        published = f'AND blogs_post.id IN ({published_sql})'
+        params.extend(published_params)
+    sql = sql.format(published=published)
+    if limit:
+        sql += ' LIMIT %s OFFSET %s'
+        params.extend([limit, offset])
+
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+    except (OperationalError, ProgrammingError) as e:
+        # The index hasn't been created (eg. SQLite without FTS5), anything else is a bug
+        if not index_missing(e):
+            raise
+        return []
+
+
+def search_posts(query, page=1, page_size=SEARCH_PAGE_SIZE):
+    """A page of published posts matching the query with a highlighted snippet each, and whether there are more"""
+    rows = matching_post_ids(query, limit=page_size + 1, offset=(page - 1) * page_size)
+    posts = Post.objects.in_bulk([post_id for post_id, _ in rows[:page_size]])
+
+    results = []
+    for post_id, snippet in rows[:page_size]:
+        if post_id in posts:
+            post = posts[post_id]
+            post.snippet = highlight(snippet or '')
+            results.append(post)
+    return results, len(rows) > page_size
+
@@ -0,0 +1,50 @@
+from django.template.loader import render_to_string
+
+from functools import cache
+import hashlib
+import re
+
+
+# Strings are kept as they are, comments dropped and whitespace collapsed (or removed around punctuation)
+CSS_TOKEN_PATTERN = re.compile(r'''("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')|/\*.*?\*/|\s*([{};,>])\s*|\s+''', flags=re.DOTALL)
+
+# (digest, css) of the stylesheet last compiled by this process
+_compiled = (None, None)
+
+
+def minify_css(css):
+    def replace(match):
+        if match.group(1):
+            return match.group(1)
+        if match.group(2):
+            return match.group(2)
+        return '' if match.group(0).startswith('/*') else ' '
+
+    return CSS_TOKEN_PATTERN.sub(replace, css).replace(';}', '}').strip()
+
+
+@cache
+def default_css():
+    return render_to_string('styles/blog/default.css')
+
+
+def effective_css(blog):
+    """The blog's stylesheet as it would be inlined by snippets/styles.html"""
+    css = '' if blog.overwrite_styles else default_css()
+    return css + '\n' + blog.custom_styles
+
+
+def compiled_stylesheet(blog):
+    """
+    Minified stylesheet and a hash of the styles it was compiled from. The hash only depends on the stored styles
+    and the theme, so every worker process agrees on it
+    """
+    global _compiled
+
+    source = effective_css(blog)
+    digest = hashlib.sha256(source.encode()).hexdigest()[:16]
+    compiled_digest, css = _compiled
+    if compiled_digest != digest:
+        css = minify_css(source)
+        _compiled = (digest, css)
+    return digest, css
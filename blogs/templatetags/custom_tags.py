@@ -1,4 +1,6 @@
 from django import template
+from django.conf import settings
+from django.core.cache import caches
 from django.utils import timezone
 from django.template.loader import render_to_string
 from django.utils import dateformat, translation
@@ -6,54 +8,33 @@ from django.utils.dateformat import format as date_format
 from django.utils.timesince import timesince
 from django.utils.text import slugify
 from django.utils.safestring import mark_safe
+from django.urls import reverse
 
 from pygments import highlight
 from pygments.lexers import get_lexer_by_name
 from pygments.formatters import HtmlFormatter
 
-from html import escape
+from html import escape, unescape
 
 from mistune import HTMLRenderer, create_markdown
 from mistune.directives import FencedDirective, RSTDirective
 from mistune.directives import Admonition, TableOfContents
 from zoneinfo import ZoneInfo
 
+from functools import lru_cache
+import hashlib
 import re
 
-from blogs.helpers import unmark
-from blogs.models import Post
+from blogs.cache import LRUCache
+from blogs.helpers import filter_by_tags, unmark
+from blogs.models import MEDIA_URL_PREFIX, Media, Post
+from blogs.profiling import profile_stage
+from blogs.sanitizer import sanitize
+from blogs.styles import compiled_stylesheet
 
 
 register = template.Library()
 
-HOST_WHITELIST = [
-    'www.youtube.com',
-    'www.youtube-nocookie.com',
-    'www.slideshare.net',
-    'player.vimeo.com',
-    'w.soundcloud.com',
-    'www.google.com',
-    'codepen.io',
-    'stackblitz.com',
-    'onedrive.live.com',
-    'docs.google.com',
-    'bandcamp.com',
-    'embed.music.apple.com',
-    'drive.google.com',
-    'share.transistor.fm',
-    'share.descript.com',
-    'mrkennedy.ca',
-    'open.spotify.com',
-    'umap.openstreetmap.fr',
-    'music.163.com',
-    'sheevcharan.substack.com',
-    'guestbooks.meadow.cafe',
-    'supercut.video',
-    'listenbrainz.org',
-    'api.listenbrainz.org',
-    'archive.org'
-]
-
 TYPOGRAPHIC_REPLACEMENTS = [
     ('(c)', '©'),
     ('(C)', '©'),
@@ -67,6 +48,30 @@ TYPOGRAPHIC_REPLACEMENTS = [
 ]
 
 
+# Highlighted code blocks keyed by (language, code hash), shared by page and feed renders
+highlight_cache = LRUCache(max_entries=2000, max_size=8 * 1024 * 1024)
+code_formatter = HtmlFormatter(style='friendly')
+
+
+@lru_cache(maxsize=256)
+def get_lexer(name):
+    # Unknown languages resolve to (and are cached as) the plain text lexer
+    try:
+        return get_lexer_by_name(name)
+    except ValueError:
+        return get_lexer_by_name('text')
+
+
+def highlight_code(code, language):
+    cache_key = (language, hashlib.sha1(code.encode()).hexdigest())
+    highlighted_code = highlight_cache.get(cache_key)
+    if highlighted_code is None:
+        with profile_stage('pygments'):
+            highlighted_code = highlight(code, get_lexer(language), code_formatter)
+        highlight_cache.set(cache_key, highlighted_code)
+    return highlighted_code
+
+
 def typographic_replacements(text):
     for old, new in TYPOGRAPHIC_REPLACEMENTS:
         text = text.replace(old, new)
@@ -138,94 +143,118 @@ class MyRenderer(HTMLRenderer):
     def block_code(self, code, info=None):
         if info is None:
             info = 'text'
-        try:
-            lexer = get_lexer_by_name(info)
-        except ValueError:
-            lexer = get_lexer_by_name('text')
-        
-        formatter = HtmlFormatter(style='friendly')
-        highlighted_code = highlight(code, lexer, formatter)
-        return highlighted_code
+        return highlight_code(code, info)
+
+MARKDOWN_PLUGINS = ['math', 'strikethrough', 'footnotes', 'table', 'superscript', 'subscript', 'mark', 'task_lists', 'abbr']
+MARKDOWN_DIRECTIVES = [Admonition, TableOfContents]
 
 markdown_renderer = create_markdown(
     renderer=MyRenderer(),
-    plugins=['math', 'strikethrough', 'footnotes', 'table', 'superscript', 'subscript', 'mark', 'task_lists', 'abbr', RSTDirective([
-        Admonition(),
-        TableOfContents(),
-    ]),],
+    plugins=MARKDOWN_PLUGINS + [RSTDirective([directive() for directive in MARKDOWN_DIRECTIVES])],
     escape=False)
 
+# Bump when MyRenderer output changes so stale cached markup is never served
+RENDERER_VERSION = 2
+RENDER_CACHE_SALT = f"{RENDERER_VERSION}:{','.join(MARKDOWN_PLUGINS)}:{','.join(d.__name__ for d in MARKDOWN_DIRECTIVES)}"
 
-@register.simple_tag(takes_context=False)
-def markdown(content, blog=None, post=None, tz=None):
-    content = str(content)
-    if not content:
-        return ''
+markdown_cache = caches['markdown']
+
+
+def render_markdown(content):
+    """Render the static (request independent) part of the markdown, with the current dimensions of uploaded images"""
+    return with_image_sizes(render_cached_markdown(content))
+
+
+def render_cached_markdown(content):
+    """Markup of the content alone, cached by content hash"""
+    cache_key = 'markdown_' + hashlib.sha256(f'{RENDER_CACHE_SALT}:{content}'.encode()).hexdigest()
+    processed_markup = markdown_cache.get(cache_key)
+    if processed_markup is not None:
+        return processed_markup
 
     # Removes old formatted inline LaTeX
     content = replace_inline_latex(content)
     # Find urls with parentheses and escape them
     content = fix_links(content)
 
-    try:
-        # TODO: Implement excluding_script to not parse script tags
-        # processed_markup = excluding_script(content)
+    with profile_stage('markdown'):
         processed_markup = markdown_renderer(content)
-    except TypeError:
-        return ''
 
-    # For personal CMS, allow all content (no upgrade restrictions)
+    # Oversized documents are rendered every time rather than evicting everything else
+    if len(processed_markup.encode()) <= settings.MARKDOWN_CACHE_MAX_ENTRY_SIZE:
+        markdown_cache.set(cache_key, processed_markup)
 
-    # Replace {{ xyz }} elements
-    if blog:
-        processed_markup = excluding_pre(processed_markup, blog, post, tz=tz)
+    return processed_markup
 
-    return mark_safe(processed_markup)
+
+# Images rendered by mistune from our media bucket. Their sizes can change after the markup is cached (eg. variants
+# generated later), so they're looked up on every render, in one query per document
+MEDIA_IMAGE_PATTERN = re.compile(r'<img src="(' + re.escape(MEDIA_URL_PREFIX) + r'[^"]*)"[^>]*? />')
 
 
-# Exclude script and style tags from markdown rendering
-def excluding_script(markup):
-    placeholders = {}
+def with_image_sizes(markup):
+    if MEDIA_URL_PREFIX not in markup:
+        return markup
 
-    def placeholder_div(match):
-        key = f"PLACEHOLDER_{len(placeholders)}"
-        print(placeholders)
-        placeholders[key] = match.group(0)
-        return key
+    urls = {unescape(url) for url in MEDIA_IMAGE_PATTERN.findall(markup)}
+    with profile_stage('image_sizes'):
+        media_by_url = Media.for_image_urls(urls)
+    if not media_by_url:
+        return markup
+    return MEDIA_IMAGE_PATTERN.sub(lambda match: image_markup(match.group(0), media_by_url.get(unescape(match.group(1)))), markup)
 
-    markup = re.sub(r'(<script.*?>.*?</script>|<style.*?>.*?</style>)', placeholder_div, markup, flags=re.DOTALL)
 
-    markup = markdown_renderer(markup)
+def image_markup(html, media):
+    if not media or not media.width:
+        return html
 
-    for key in sorted(placeholders.keys(), reverse=True):
-        markup = markup.replace(key, placeholders[key])
+    # Width and height reserve the space before the image loads
+    attributes = f' width="{media.width}" height="{media.height}"'
+    sources = ''
+    variants_by_type = {}
+    for variant in media.image_variants:
+        variants_by_type.setdefault(variant['content_type'], []).append(variant)
 
-    return markup
+    webp_variants = variants_by_type.pop('image/webp', [])
+    if webp_variants:
+        srcset = ', '.join(f"{v['url']} {v['width']}w" for v in sorted(webp_variants + [{'url': media.url, 'width': media.width}], key=lambda v: v['width']))
+        attributes += f' srcset="{escape(srcset)}" sizes="{escape(settings.IMAGE_SIZES)}"'
+    for content_type, variants in variants_by_type.items():
+        # Other formats (AVIF) are only offered when they go up to the image's own width
+        if max(v['width'] for v in variants) >= media.width:
+            type_srcset = ', '.join(f"{v['url']} {v['width']}w" for v in variants)
+            sources += f'<source type="{content_type}" srcset="{escape(type_srcset)}" sizes="{escape(settings.IMAGE_SIZES)}">'
 
+    html = html[:-len(' />')] + attributes + ' />'
+    return f'<picture>{sources}{html}</picture>' if sources else html
 
-# Replace elements in all but pre and code tags
-def excluding_pre(markup, blog=None, post=None, tz=None):
-    placeholders = {}
 
-    def placeholder_div(match):
-        key = f"PLACEHOLDER_{len(placeholders)}"
-        placeholders[key] = match.group(0)
-        return key
+@register.simple_tag(takes_context=False)
+def markdown(content, blog=None, post=None, tz=None):
+    content = str(content)
+    if not content:
+        return ''
+
+    try:
+        processed_markup = render_markdown(content)
+    except TypeError:
+        return ''
 
-    markup = re.sub(r'(<pre.*?>.*?</pre>|<code.*?>.*?</code>)', placeholder_div, markup, flags=re.DOTALL)
+    # For personal CMS, allow all content (no upgrade restrictions)
 
+    # Replace {{ xyz }} elements
     if blog:
-        if post: 
-            markup = element_replacement(markup, blog, post, tz=tz)
-        else:
-            markup = element_replacement(markup, blog, tz=tz)
-    else:
-        markup = element_replacement(markup, tz=tz)
+        processed_markup = excluding_pre(processed_markup, blog, post, tz=tz)
 
-    for key in sorted(placeholders.keys(), reverse=True):
-        markup = markup.replace(key, placeholders[key])
+    return mark_safe(processed_markup)
 
-    return markup
+
+# Replace elements in all but pre and code tags
+def excluding_pre(markup, blog=None, post=None, tz=None):
+    if blog is None or '{{' not in markup:
+        return markup
+    with profile_stage('excluding_pre'):
+        return element_replacement(markup, blog, post, tz=tz)
 
 
 def apply_filters(posts, tag=None, limit=None, order=None):
@@ -237,7 +266,7 @@ def apply_filters(posts, tag=None, limit=None, order=None):
         # Split tags by comma and strip whitespace
         tags = [t.strip() for t in tag.replace('"', '').split(',')]
         if tags:
-            posts = [post for post in posts if all(tag in post.tags for tag in tags)]
+            posts = filter_by_tags(posts, tags)
     if limit is not None:
         try:
             limit = int(limit)
@@ -247,38 +276,81 @@ def apply_filters(posts, tag=None, limit=None, order=None):
     return posts
 
 
+def render_posts_directive(params_str, blog, post=None, tz=None):
+    tag, limit, order, description, image, content = None, None, None, False, False, False
+
+    # Extract and process parameters one by one
+    params = POSTS_PARAM_PATTERN.findall(params_str)
+    for param in params:
+        if 'tag:' in param[0]:
+            tag = param[1].strip()
+        elif 'limit:' in param[0]:
+            limit = int(param[2])
+        elif 'order:' in param[0]:
+            order = param[3]
+        elif 'description:' in param[0]:
+            description = param[4] == 'True'
+        elif 'image:' in param[0]:
+            image  = param[5] == 'True'
+        # Only show content if injection is on page or homepage
+        elif 'content:' in param[0] and not post or post.is_page:
+            content = param[6] == 'True'
+
+    filtered_posts = apply_filters(Post.objects.filter(publish=True, is_page=False, published_date__lte=timezone.now()), tag, limit, order)
+    context = {'blog': blog, 'posts': filtered_posts, 'embed': True, 'show_description': description, 'show_image': image, 'show_content': content, 'tz': tz}
+    return render_to_string('snippets/post_list.html', context)
+
+
+# Values for the {{ xyz }} directives, only computed when the directive is present in the markup
+BLOG_DIRECTIVES = {
+    'email-signup': lambda blog, post, tz: render_to_string('snippets/email_subscribe_form.html'),
+    'blog_title': lambda blog, post, tz: escape(blog.title),
+    'blog_description': lambda blog, post, tz: escape(blog.meta_description),
+    'blog_created_date': lambda blog, post, tz: format_date(blog.created_date, blog.date_format, blog.lang, tz),
+    'blog_last_modified': lambda blog, post, tz: timesince(blog.last_modified),
+    'blog_last_posted': lambda blog, post, tz: timesince(blog.last_posted) if blog.last_posted else '',
+    'tags': lambda blog, post, tz: render_to_string('snippets/blog_tags.html', {"tags": blog.tags, "blog_path": blog.blog_path or "blog"}),
+    'blog_link': lambda blog, post, tz: f"{blog.useful_domain}",
+}
+
+POST_DIRECTIVES = {
+    'post_title': lambda blog, post, tz: escape(post.title),
+    'post_description': lambda blog, post, tz: escape(post.meta_description),
+    'post_published_date': lambda blog, post, tz: format_date(post.published_date, blog.date_format, blog.lang, tz),
+    'post_last_modified': lambda blog, post, tz: timesince(post.last_modified or timezone.now()),
+    'post_link': lambda blog, post, tz: f"{blog.useful_domain}/{post.slug}",
+}
+
+POSTS_PARAM_PATTERN = re.compile(r'(tag:([^|}\s][^|}]*)|limit:(\d+)|order:(asc|desc)|description:(True)|image:(True)|content:(True))')
+
+# A single scan finds pre/code blocks (left untouched), the {{ posts ... }} directive with its
+# parameters, and every other directive ({{email-signup}} is also accepted without spaces)
+DIRECTIVE_PATTERN = re.compile(
+    r'(?P<code><pre.*?>.*?</pre>|<code.*?>.*?</code>)'
+    r'|\{\{\s*posts(?P<params>[^}]*)\}\}'
+    r'|\{\{(?: (?P<name>' + '|'.join(re.escape(name) for name in [*BLOG_DIRECTIVES, *POST_DIRECTIVES]) + r') |(?P<bare>email-signup))\}\}',
+    re.DOTALL)
+
+
 def element_replacement(markup, blog, post=None, tz=None):
-    # Match the entire {{ posts ... }} directive, including parameters
-    pattern = r'\{\{\s*posts([^}]*)\}\}'
-    
-    def replace_with_filtered_posts(match):
-        params_str = match.group(1) 
-        tag, limit, order, description, image, content = None, None, None, False, False, False
-        
-        # Extract and process parameters one by one
-        param_pattern = r'(tag:([^|}\s][^|}]*)|limit:(\d+)|order:(asc|desc)|description:(True)|image:(True)|content:(True))'
-        params = re.findall(param_pattern, params_str)
-        for param in params:
-            if 'tag:' in param[0]:
-                tag = param[1].strip()
-            elif 'limit:' in param[0]:
-                limit = int(param[2])
-            elif 'order:' in param[0]:
-                order = param[3]
-            elif 'description:' in param[0]:
-                description = param[4] == 'True'
-            elif 'image:' in param[0]:
-                image  = param[5] == 'True'
-            # Only show content if injection is on page or homepage
-            elif 'content:' in param[0] and not post or post.is_page:
-                content = param[6] == 'True'
-
-        filtered_posts = apply_filters(blog.posts.filter(publish=True, is_page=False, published_date__lte=timezone.now()), tag, limit, order)
-        context = {'blog': blog, 'posts': filtered_posts, 'embed': True, 'show_description': description, 'show_image': image, 'show_content': content, 'tz': tz}
-        return render_to_string('snippets/post_list.html', context)
-
-    # Replace each matched directive with rendered content
-    markup = re.sub(pattern, replace_with_filtered_posts, markup)
+    values = {}
+
+    def replace_directive(match):
+        if match.group('code') is not None:
+            return match.group(0)
+        if match.group('params') is not None:
+            return render_posts_directive(match.group('params'), blog, post, tz=tz)
+
+        name = match.group('name') or match.group('bare')
+        if name not in values:
+            if name in BLOG_DIRECTIVES:
+                values[name] = BLOG_DIRECTIVES[name](blog, post, tz)
+            elif post:
+                values[name] = POST_DIRECTIVES[name](blog, post, tz)
+            else:
+                # Post directives are left as is outside of posts
+                values[name] = match.group(0)
+        return values[name]
 
     # Date translation replacement
     current_lang = "en" # translation.get_language()
@@ -286,30 +358,7 @@ def element_replacement(markup, blog, post=None, tz=None):
     if post:
         translation.activate(post.lang)
 
-    # For personal CMS, allow email signup forms
-    markup = markup.replace('{{ email-signup }}', render_to_string('snippets/email_subscribe_form.html'))
-    markup = markup.replace('{{email-signup}}', render_to_string('snippets/email_subscribe_form.html'))
-
-    markup = markup.replace('{{ blog_title }}', escape(blog.title))
-    markup = markup.replace('{{ blog_description }}', escape(blog.meta_description))
-    markup = markup.replace('{{ blog_created_date }}', format_date(blog.created_date, blog.date_format, blog.lang, tz))
-    markup = markup.replace('{{ blog_last_modified }}', timesince(blog.last_modified))
-    if blog.last_posted:
-        markup = markup.replace('{{ blog_last_posted }}', timesince(blog.last_posted))
-    else:
-        markup = markup.replace('{{ blog_last_posted }}', '')
-
-    markup = markup.replace('{{ tags }}', render_to_string('snippets/blog_tags.html', {"tags": blog.tags, "blog_path": blog.blog_path or "blog"}))
-        
-    markup = markup.replace('{{ blog_link }}', f"{blog.useful_domain}")
-
-    if post:
-        markup = markup.replace('{{ post_title }}', escape(post.title))
-        markup = markup.replace('{{ post_description }}', escape(post.meta_description))
-        markup = markup.replace('{{ post_published_date }}', format_date(post.published_date, blog.date_format, blog.lang, tz))
-        last_modified = post.last_modified or timezone.now()
-        markup = markup.replace('{{ post_last_modified }}', timesince(last_modified))
-        markup = markup.replace('{{ post_link }}', f"{blog.useful_domain}/{post.slug}")
+    markup = DIRECTIVE_PATTERN.sub(replace_directive, markup)
 
     translation.activate(current_lang)
 
@@ -318,24 +367,18 @@ def element_replacement(markup, blog, post=None, tz=None):
 
 @register.filter
 def clean(markup):
-    cleaned_markup = re.sub(r'<script.*?>.*?</script>', '', markup, flags=re.DOTALL | re.IGNORECASE)
-    
-    cleaned_markup = re.sub(r'\son\w+="[^"]*"', '', cleaned_markup, flags=re.IGNORECASE)
-    cleaned_markup = re.sub(r'\son\w+=\'[^\']*\'', '', cleaned_markup, flags=re.IGNORECASE)
-    cleaned_markup = re.sub(r'\son\w+=\w+', '', cleaned_markup, flags=re.IGNORECASE)
-    cleaned_markup = re.sub(r'(<\w+\s+.*?)(href|src)\s*=\s*["\']?javascript:[^"\']*["\']?', r'\1', cleaned_markup, flags=re.IGNORECASE)
-    cleaned_markup = re.sub(r'<(object|embed|form|input|button).*?>', '', cleaned_markup, flags=re.IGNORECASE)
-    cleaned_markup = re.sub(r'</(object|embed|form|input|button)>', '', cleaned_markup, flags=re.IGNORECASE)
-    
-    def iframe_whitelisted(match):
-        src = match.group(2)
-        if any(host in src for host in HOST_WHITELIST):
-            return match.group(0)
-        return ''
+    with profile_stage('clean'):
+        return sanitize(markup)
+
 
-    cleaned_markup = re.sub(r'(<iframe.*?src=["\'])([^"\']*)(["\'].*?>.*?</iframe>)', iframe_whitelisted, cleaned_markup, flags=re.DOTALL | re.IGNORECASE)
+@register.simple_tag(takes_context=True)
+def blog_stylesheet(context, blog):
+    """Link to the blog's compiled stylesheet, inlined instead for style previews or when INLINE_STYLES is set"""
+    if not blog or context.get('preview') or settings.INLINE_STYLES:
+        return mark_safe(f"<style>{render_to_string('snippets/styles.html', {'blog': blog})}</style>")
 
-    return cleaned_markup
+    digest, _ = compiled_stylesheet(blog)
+    return mark_safe(f'<link rel="stylesheet" href="{reverse("stylesheet", args=[digest])}">')
 
 
 @register.filter
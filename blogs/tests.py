@@ -0,0 +1,255 @@
+from django.db import connection
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.urls import ResolverMatch
+from django.utils import timezone
+
+from datetime import timedelta
+from unittest import mock
+import json
+import tempfile
+
+from blogs.backup import backup_blog, load_manifest
+from blogs.cache import bump_content_version, get_content_version
+from blogs.helpers import get_blog
+from blogs.jobs import run_job
+from blogs.middleware import RateLimitMiddleware
+from blogs.models import MEDIA_URL_PREFIX, Blog, ContentVersion, Media, Post
+from blogs.sanitizer import sanitize_markup as sanitize
+from blogs.search import SEARCH_TABLE, matching_post_ids, search_posts
+from blogs.styles import compiled_stylesheet
+from blogs.templatetags.custom_tags import render_markdown
+
+
+class SanitizerTests(SimpleTestCase):
+    def assertNoLiveHandler(self, markup):
+        self.assertNotRegex(sanitize(markup), r'<[a-z][^<>]*\sonerror')
+
+    def test_style_inside_math_is_sanitized_as_markup(self):
+        self.assertNoLiveHandler('<math><style><img src=x onerror=alert(1)>')
+
+    def test_style_inside_svg_is_sanitized_as_markup(self):
+        self.assertNoLiveHandler('<svg><style><img src=x onerror=alert(1)></style></svg>')
+
+    def test_comments_are_dropped(self):
+        self.assertEqual(sanitize('a<!--><img src=x onerror=alert(1)>-->b'), 'ab')
+        self.assertNoLiveHandler('<!--><img src=x onerror=alert(1)>-->')
+
+    def test_noscript_contents_are_escaped(self):
+        markup = '<noscript><p title="</noscript><img src=x onerror=alert(1)>">'
+        self.assertNoLiveHandler(markup)
+        self.assertTrue(sanitize(markup).startswith('<noscript>&lt;p title="</noscript>'))
+
+    def test_raw_text_elements_are_escaped(self):
+        for tag in ('xmp', 'noembed', 'noframes', 'textarea', 'title'):
+            markup = f'<{tag}><p title="</{tag}><img src=x onerror=alert(1)>">'
+            self.assertNoLiveHandler(markup)
+            self.assertTrue(sanitize(markup).startswith(f'<{tag}>&lt;p title="</{tag}>'), tag)
+
+    def test_raw_text_elements_cannot_be_ended_early(self):
+        for tag in ('xmp', 'textarea', 'title'):
+            self.assertNoLiveHandler(f'<{tag}></{tag} x><img src=x onerror=alert(1)>')
+
+    def test_iframe_contents_are_escaped(self):
+        markup = '<iframe src="https://www.youtube.com/embed/x"><p title="</iframe><img src=x onerror=alert(1)>"></iframe>'
+        self.assertNoLiveHandler(markup)
+        self.assertTrue(sanitize(markup).startswith('<iframe src="https://www.youtube.com/embed/x">&lt;p title="</iframe>'))
+        self.assertNoLiveHandler('<iframe src="https://evil.example"><p title="</iframe><img src=x onerror=alert(1)>"></iframe>')
+
+    def test_title_inside_svg_is_sanitized_as_markup(self):
+        self.assertEqual(sanitize('<svg><title><b onclick="x()">Chart</b></title></svg>'), '<svg><title><b>Chart</b></title></svg>')
+
+    def test_cdata_sections_are_dropped(self):
+        self.assertNoLiveHandler('<![CDATA[><img src=x onerror=alert(1)>]]>')
+
+    def test_top_level_style_keeps_raw_text(self):
+        self.assertEqual(sanitize('<style>a > b { color: red }</style>'), '<style>a > b { color: red }</style>')
+
+    def test_style_cannot_be_ended_early(self):
+        # Browsers end a stylesheet at "</style x>", so the image would otherwise be live
+        for markup in ('<style></style x><img src=x onerror=alert(1)></style>', '<style></style x><img src=x onerror=alert(1)>'):
+            sanitized = sanitize(markup)
+            self.assertEqual(sanitized.lower().count('</style'), 1)
+            self.assertTrue(sanitized.endswith('</style>'))
+
+    def test_style_after_svg_keeps_raw_text(self):
+        self.assertEqual(sanitize('<svg></svg><style>a > b {}</style>'), '<svg></svg><style>a > b {}</style>')
+
+    def test_event_handlers_and_scripts_are_removed(self):
+        self.assertEqual(sanitize('<p onclick="x()">hi</p><script>alert(1)</script>'), '<p>hi</p>')
+        self.assertEqual(sanitize('<a href="java\tscript:alert(1)">x</a>'), '<a>x</a>')
+
+
+@override_settings(CONTENT_VERSION_POLL_INTERVAL=0)
+class ContentVersionTests(TestCase):
+    def test_version_is_read_from_the_database(self):
+        version = bump_content_version()
+        self.assertEqual(get_content_version(), version)
+
+        # As bumped by another worker process
+        ContentVersion.objects.filter(pk=ContentVersion.SINGLETON_ID).update(version='other')
+        self.assertEqual(get_content_version(), 'other')
+
+    def test_cached_blog_follows_the_shared_version(self):
+        blog = get_blog()
+        Blog.objects.filter(pk=blog.pk).update(title='Renamed')
+        ContentVersion.objects.filter(pk=ContentVersion.SINGLETON_ID).update(version='other')
+        self.assertEqual(get_blog().title, 'Renamed')
+
+    def test_post_stats_refresh_bumps_the_version_again(self):
+        Blog.objects.create(title='Blog')
+        Post.objects.create(title='Post', slug='post', content='Hello', all_tags='["tag"]', published_date=timezone.now() - timedelta(days=1))
+        version = get_content_version()
+
+        run_job('refresh_post_stats', '[[], {}]')
+        self.assertNotEqual(get_content_version(), version)
+        self.assertEqual(get_blog().tags, ['tag'])
+
+    def test_deleting_the_blog_bumps_the_version(self):
+        version = get_content_version()
+        get_blog().delete()
+        self.assertNotEqual(get_content_version(), version)
+
+
+@override_settings(CONTENT_VERSION_POLL_INTERVAL=0)
+class ConditionalPageTests(TestCase):
+    def setUp(self):
+        Blog.objects.create(title='Blog', content='Hello')
+
+    def test_etag_is_honoured_until_the_shared_version_changes(self):
+        etag = self.client.get('/')['ETag']
+        self.assertEqual(self.client.get('/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        # Bumped by another worker process, which also changed the content
+        Blog.objects.update(content='Changed')
+        ContentVersion.objects.filter(pk=ContentVersion.SINGLETON_ID).update(version='other')
+        response = self.client.get('/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Changed')
+
+
+class StylesheetTests(TestCase):
+    def setUp(self):
+        self.blog = Blog.objects.create(title='Blog', custom_styles='body { color: red; }')
+
+    def test_digest_depends_on_the_stored_styles(self):
+        digest, _ = compiled_stylesheet(self.blog)
+        self.assertEqual(compiled_stylesheet(Blog.objects.get(pk=self.blog.pk))[0], digest)
+
+        self.blog.custom_styles = 'body { color: blue; }'
+        self.assertNotEqual(compiled_stylesheet(self.blog)[0], digest)
+
+    def test_stale_digest_is_served_without_caching(self):
+        digest, css = compiled_stylesheet(self.blog)
+        response = self.client.get(f'/styles/{digest}.css')
+        self.assertEqual(response.content.decode(), css)
+        self.assertIn('immutable', response['Cache-Control'])
+
+        response = self.client.get('/styles/0000000000000000.css')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content.decode(), css)
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+
+
+class FeedAliasTests(TestCase):
+    def setUp(self):
+        Blog.objects.create(title='Blog', rss_alias='updates')
+
+    def test_compressed_feed_is_not_served_to_other_clients(self):
+        response = self.client.get('/updates/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+
+        response = self.client.get('/updates/')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertIn(b'<feed', response.content)
+
+    def test_compressed_feed_has_its_own_etag(self):
+        gzip_etag = self.client.get('/feed/', HTTP_ACCEPT_ENCODING='gzip')['ETag']
+        identity_etag = self.client.get('/feed/')['ETag']
+        self.assertNotEqual(gzip_etag, identity_etag)
+
+        self.assertEqual(self.client.get('/feed/', HTTP_IF_NONE_MATCH=identity_etag).status_code, 304)
+        self.assertEqual(self.client.get('/feed/', HTTP_IF_NONE_MATCH=gzip_etag).status_code, 200)
+
+    def test_tag_filter_matches_part_of_a_tag(self):
+        Post.objects.create(title='Snakes', slug='snakes', content='Hiss', all_tags='["python"]', published_date=timezone.now() - timedelta(days=1))
+        self.assertIn(b'Snakes', self.client.get('/feed/?q=pyth').content)
+
+
+class SearchTests(TestCase):
+    def test_text_inside_markdown_syntax_is_indexed(self):
+        content = '# Heading words\nSome **veniam** and [link text](https://example.com)\n- listed item\n> quoted line\n`inline_code`'
+        post = Post.objects.create(title='Post', slug='post', content=content, published_date=timezone.now() - timedelta(days=1))
+
+        for query in ('veniam', 'heading', 'link text', 'listed', 'quoted', 'inline_code'):
+            results, _ = search_posts(query)
+            self.assertEqual([result.pk for result in results], [post.pk], query)
+
+    def test_like_fallback_only_finds_published_posts(self):
+        post = Post.objects.create(title='Veniam', slug='post', content='Hello', published_date=timezone.now() - timedelta(days=1))
+        Post.objects.create(title='Veniam later', slug='later', content='Hello', published_date=timezone.now() + timedelta(days=1))
+
+        with mock.patch('blogs.search.search_backend', return_value=None):
+            self.assertEqual(matching_post_ids('veniam'), [(post.pk, '')])
+
+    def test_missing_index_finds_nothing(self):
+        Post.objects.create(title='Veniam', slug='post', content='Hello', published_date=timezone.now() - timedelta(days=1))
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP TABLE {SEARCH_TABLE}')
+
+        self.assertEqual(matching_post_ids('veniam'), [])
+
+    def test_post_published_as_search_keeps_its_url(self):
+        Post.objects.create(title='Find things', slug='search', content='Look around', published_date=timezone.now() - timedelta(days=1))
+
+        self.assertContains(self.client.get('/search/'), 'Look around')
+        self.assertContains(self.client.get('/search/?q=look'), 'Find things')
+
+
+class MediaTests(TestCase):
+    def test_allocate_name_skips_taken_names(self):
+        for name in ('photo.jpg', 'photo-1.jpg', 'photograph.jpg'):
+            Media.objects.create(url=f'https://example.com/{name}', name=name)
+
+        self.assertEqual(Media.allocate_name('photo', 'jpg'), 'photo-2.jpg')
+        self.assertEqual(Media.allocate_name('photog', 'jpg'), 'photog.jpg')
+
+    def test_image_sizes_follow_the_media_after_the_markup_is_cached(self):
+        url = f'{MEDIA_URL_PREFIX}blog/photo.jpg'
+        content = f'![A photo]({url})'
+        self.assertNotIn('width=', render_markdown(content))
+
+        Media.objects.create(url=url, name='photo.jpg', width=1200, height=800, variants=json.dumps([
+            {'url': f'{MEDIA_URL_PREFIX}blog/photo-640.webp', 'width': 640, 'content_type': 'image/webp'},
+        ]))
+        markup = render_markdown(content)
+        self.assertIn('width="1200" height="800"', markup)
+        self.assertIn('photo-640.webp 640w', markup)
+
+
+class BackupTests(TestCase):
+    def test_incremental_backup_includes_edited_posts(self):
+        blog = Blog.objects.create(title='Blog')
+        post = Post.objects.create(title='Post', slug='post', content='First', published_date=timezone.now())
+        # Written long before the first backup
+        Post.objects.filter(pk=post.pk).update(last_modified=timezone.now() - timedelta(days=1))
+        post.refresh_from_db()
+
+        with tempfile.TemporaryDirectory() as root:
+            self.assertEqual(backup_blog(blog, root=root)['post_count'], 1)
+
+            post.content = 'Edited'
+            post.save()
+            self.assertEqual(backup_blog(blog, root=root)['post_count'], 1)
+            self.assertEqual(len(load_manifest(root)['segments']), 2)
+
+
+class RateLimitTests(SimpleTestCase):
+    def test_ping_is_never_limited(self):
+        def ping(request):
+            pass
+
+        middleware = RateLimitMiddleware(lambda request: None)
+        request = RequestFactory().get('/ping/')
+        request.resolver_match = ResolverMatch(ping, (), {}, url_name='ping')
+        for _ in range(RateLimitMiddleware.RATE_LIMIT + 1):
+            self.assertIsNone(middleware.process_view(request, ping, (), {}))
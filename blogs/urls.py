@@ -18,10 +18,12 @@ urlpatterns = [
     path('dashboard/media/', media.media_center, name='media_center'),
     path('dashboard/media/delete-selected/', media.delete_selected_media, name='delete_selected_media'),
     path('dashboard/upload-image/', media.upload_image, name='upload_image'),
-    path('media/<str:img>/', media.image_proxy, name="image-proxy"),
+    path('media/<path:img>/', media.image_proxy, name="image-proxy"),
 
     # Analytics (simplified)
     path('dashboard/analytics/', analytics.analytics, name='analytics'),
+    path('dashboard/performance/', analytics.performance, name='performance'),
+    path('dashboard/profiling/', analytics.profiling, name='profiling'),
 
     # Email (simplified for personal CMS)
     path('dashboard/emails/', emailer.email_list, name='email_list'),
@@ -40,7 +42,10 @@ urlpatterns = [
 
     # Blog
     path('sitemap.xml', blog.sitemap, name='sitemap'),
+    path('styles/<str:digest>.css', blog.stylesheet, name='stylesheet'),
+    path('sitemap-<int:page>.xml', blog.sitemap, name='sitemap_page'),
     path('robots.txt', blog.robots, name='robots'),
+    path('search/', blog.search, name='search'),
 
     # Feeds + aliases
     path("feed/", feed.feed),
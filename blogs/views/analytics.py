@@ -1,15 +1,18 @@
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
 from django.shortcuts import render
 from django.utils import timezone
 from django.http import HttpResponse
 
-from blogs.models import Blog, Post
+from blogs.helpers import get_blog
+from blogs.middleware import metrics_recorder
+from blogs.models import Post
+from blogs.profiling import summarise_profiles
 
 
 def analytics(request):
     """Simple analytics view showing basic post statistics"""
-    blog = Blog.objects.first()
-    if not blog:
-        return render(request, '404.html', status=404)
+    blog = get_blog(request)
 
     # Get published posts with basic stats
     posts = Post.objects.filter(publish=True, published_date__lte=timezone.now()).order_by('-published_date')
@@ -37,4 +40,45 @@ def analytics(request):
 
 def post_hit(request, uid):
     """Simplified hit tracking - just return success for compatibility"""
-    return HttpResponse("Logged")
\ No newline at end of file
+    return HttpResponse("Logged")
+
+
+@staff_member_required
+def performance(request):
+    """Request timing percentiles collected by RequestPerformanceMiddleware"""
+    blog = get_blog(request)
+
+    return render(request, 'dashboard/performance.html', {
+        'blog': blog,
+        'enabled': settings.REQUEST_METRICS_ENABLED,
+        'summary': metrics_recorder.get_summary(),
+    })
+
+
+@staff_member_required
+def profiling(request):
+    """Per-stage timings of sampled requests, with the hot path caches' hit rates"""
+    from blogs.templatetags.custom_tags import get_lexer, highlight_cache
+    from blogs.views.feed import feed_snapshots, tagged_feed_snapshots
+
+    blog = get_blog(request)
+    lexer_info = get_lexer.cache_info()
+    lexer_lookups = lexer_info.hits + lexer_info.misses
+
+    return render(request, 'dashboard/profiling.html', {
+        'blog': blog,
+        'enabled': settings.PROFILING_ENABLED,
+        'sample_rate': settings.PROFILING_SAMPLE_RATE,
+        'summary': summarise_profiles(),
+        'caches': {
+            'Highlighted code': highlight_cache.stats(),
+            'Lexers': {
+                'entries': lexer_info.currsize,
+                'hits': lexer_info.hits,
+                'misses': lexer_info.misses,
+                'hit_rate': lexer_info.hits / lexer_lookups if lexer_lookups else 0.0,
+            },
+            'Feed snapshots': feed_snapshots.stats(),
+            'Tagged feed snapshots': tagged_feed_snapshots.stats(),
+        },
+    })
@@ -1,30 +1,35 @@
-from django.http import HttpResponse
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+from django.http import HttpResponse, StreamingHttpResponse
 from django.http.response import Http404
 from django.shortcuts import get_object_or_404, render, redirect
 from django.utils import timezone
+from django.utils.html import escape
 from django.utils.text import slugify
 
-from blogs.models import Blog, Post
-from blogs.helpers import unmark
+from blogs.cache import cache_page, conditional_page, content_last_modified, request_content_version
+from blogs.models import Blog, Post, PostTag
+from blogs.helpers import filter_by_tags, get_blog
+from blogs.search import search_posts
+from blogs.styles import compiled_stylesheet
 
-def get_blog():
-    """Get the single blog instance for personal CMS"""
-    blog = Blog.objects.first()
-    if not blog:
-        # Create default blog if none exists
-        blog = Blog.objects.create(
-            title="My Personal Blog",
-            content="Welcome to my personal blog!"
-        )
-    return blog
+import math
 
 
+# The sitemap protocol allows 50,000 URLs per file, larger blogs get a sitemap index
+SITEMAP_MAX_URLS = 50000
+SITEMAP_CHUNK_SIZE = 2000
+
+
+@conditional_page
+@cache_page
 def home(request):
-    blog = get_blog()
+    blog = get_blog(request)
 
     all_posts = Post.objects.filter(publish=True, published_date__lte=timezone.now(), is_page=False).order_by('-published_date')
 
-    meta_description = blog.meta_description or unmark(blog.content)[:157] + '...'
+    meta_description = blog.description
 
     return render(
         request,
@@ -37,8 +42,10 @@ def home(request):
     )
 
 
+@conditional_page
+@cache_page
 def posts(request):
-    blog = get_blog()
+    blog = get_blog(request)
 
     tag_param = request.GET.get('q', '')
     tags = [t.strip() for t in tag_param.split(',')] if tag_param else []
@@ -47,16 +54,14 @@ def posts(request):
     posts = Post.objects.filter(publish=True, published_date__lte=timezone.now(), is_page=False).order_by('-published_date')
     if tags:
         # Filter posts that contain ALL specified tags
-        posts = [post for post in posts if all(tag in post.tags for tag in tags)]
-        
-        available_tags = set()
-        for post in posts:
-            available_tags.update(post.tags)
+        posts = filter_by_tags(posts, tags)
+
+        available_tags = set(PostTag.objects.filter(post__in=posts.values('pk')).values_list('name', flat=True).distinct())
 
     else:
         available_tags = set(blog.tags)
 
-    meta_description = blog.meta_description or unmark(blog.content)[:157] + '...'
+    meta_description = blog.description
 
     blog_path_title = 'Blog'
 
@@ -75,6 +80,42 @@ def posts(request):
     )
 
 
+
+def search(request):
+    # Posts and pages published as /search/ before search was added keep their URL, searches still work with ?q=
+    if 'q' not in request.GET and Post.objects.filter(Q(slug__iexact='search') | Q(alias__iexact='search')).exists():
+        return post(request, 'search')
+
+    return search_results(request)
+
+
+@conditional_page
+@cache_page
+def search_results(request):
+    blog = get_blog(request)
+
+    query = request.GET.get('q', '').strip()[:200]
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        page = 1
+
+    posts, has_next = search_posts(query, page) if query else ([], False)
+
+    return render(
+        request,
+        'search.html',
+        {
+            'blog': blog,
+            'posts': posts,
+            'query': query,
+            'page': page,
+            'has_next': has_next,
+            'meta_description': blog.description,
+        }
+    )
+
+
 def post(request, slug):
     # Prevent null characters in path
     slug = slug.replace('\x00', '')
@@ -82,13 +123,19 @@ def post(request, slug):
     if slug[0] == '/' and slug[-1] == '/':
         slug = slug[1:-1]
 
-    blog = get_blog()
-
-    # Check for RSS feed path
-    if slug == blog.rss_alias:
+    # Check for RSS feed path. The feed is compressed per client, so it's kept out of the page cache
+    if slug == get_blog(request).rss_alias:
         from blogs.views.feed import feed
         return feed(request)
 
+    return post_page(request, slug)
+
+
+@conditional_page
+@cache_page
+def post_page(request, slug):
+    blog = get_blog(request)
+
     # Find by post slug
     post = Post.objects.filter(slug__iexact=slug).first()
 
@@ -105,7 +152,7 @@ def post(request, slug):
 
             return render(request, '404.html', {'blog': blog}, status=404)
 
-    meta_description = post.meta_description or unmark(post.content)[:157] + '...'
+    meta_description = post.description
     canonical_url = post.canonical_url if post.canonical_url and post.canonical_url.startswith('https://') else f'/{post.slug}/'
 
     if post.publish is False and not request.GET.get('token') == post.token:
@@ -123,22 +170,90 @@ def post(request, slug):
 
 
 def not_found(request, *args, **kwargs):
-    blog = get_blog()
+    blog = get_blog(request)
     return render(request, '404.html', {'blog': blog}, status=404)
 
 
-def sitemap(request):
-    blog = get_blog()
+@conditional_page
+def sitemap(request, page=None):
+    blog = get_blog(request)
+
+    cache_key = f'sitemap_{request_content_version(request)}_{page}'
+    content = cache.get(cache_key)
+    if content is not None:
+        return HttpResponse(content, content_type='text/xml')
+
+    posts = Post.objects.filter(publish=True, published_date__lte=timezone.now()).order_by('-published_date')
+    # The home page is the first URL of the first sitemap
+    page_count = math.ceil((posts.count() + 1) / SITEMAP_MAX_URLS)
+
+    if page is None and page_count > 1:
+        chunks = sitemap_index(blog, page_count, content_last_modified(request))
+    elif page is None:
+        chunks = sitemap_urlset(blog, posts, include_home=True)
+    elif 1 <= page <= page_count and page_count > 1:
+        start = max((page - 1) * SITEMAP_MAX_URLS - 1, 0)
+        end = page * SITEMAP_MAX_URLS - 1
+        chunks = sitemap_urlset(blog, posts[start:end], include_home=page == 1)
+    else:
+        return not_found(request)
+
+    return StreamingHttpResponse(cache_streamed(chunks, cache_key), content_type='text/xml')
+
+
+def cache_streamed(chunks, cache_key):
+    # Only a fully streamed sitemap is cached, an aborted response is simply regenerated
+    content = []
+    for chunk in chunks:
+        content.append(chunk)
+        yield chunk
+    cache.set(cache_key, ''.join(content), settings.PAGE_CACHE_TIMEOUT)
 
-    try:
-        posts = Post.objects.filter(publish=True, published_date__lte=timezone.now()).only('slug', 'last_modified').order_by('-published_date')
-    except AttributeError:
-        posts = []
 
-    return render(request, 'sitemap.xml', {'blog': blog, 'posts': posts}, content_type='text/xml')
+def sitemap_entry(tag, loc, lastmod):
+    lastmod = f'<lastmod>{timezone.localtime(lastmod):%Y-%m-%d}</lastmod>' if lastmod else ''
+    return f'    <{tag}>\n        <loc>{escape(loc)}</loc>{lastmod}\n    </{tag}>\n'
+
+
+def sitemap_urlset(blog, posts, include_home=False):
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+
+    chunk = []
+    if include_home:
+        chunk.append(sitemap_entry('url', f'{blog.useful_domain}/', blog.last_modified))
+    for slug, last_modified in posts.values_list('slug', 'last_modified').iterator(chunk_size=SITEMAP_CHUNK_SIZE):
+        chunk.append(sitemap_entry('url', f'{blog.useful_domain}/{slug}/', last_modified))
+        if len(chunk) >= SITEMAP_CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+
+    chunk.append('</urlset>\n')
+    yield ''.join(chunk)
+
+
+def sitemap_index(blog, page_count, last_modified):
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+    for page in range(1, page_count + 1):
+        yield sitemap_entry('sitemap', f'{blog.useful_domain}/sitemap-{page}.xml', last_modified)
+    yield '</sitemapindex>\n'
+
+
+def stylesheet(request, digest):
+    blog = get_blog(request)
+    current_digest, css = compiled_stylesheet(blog)
+
+    response = HttpResponse(css, content_type='text/css; charset=utf-8')
+    if digest == current_digest:
+        response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        # Linked from a page rendered before the styles changed (or by a worker yet to see the change). The current
+        # styles are served rather than redirecting, but not cached under the old URL
+        response['Cache-Control'] = 'no-cache'
+    return response
 
 
+@cache_page
 def robots(request):
-    blog = get_blog()
+    blog = get_blog(request)
 
     return render(request, 'robots.txt',  {'blog': blog}, content_type="text/plain")
@@ -6,23 +6,13 @@ from django.utils.text import slugify
 from unicodedata import lookup
 
 from blogs.forms import NavForm, StyleForm
-from blogs.helpers import get_country, is_protected
+from blogs.helpers import get_blog, get_country, is_protected
 from blogs.models import Blog, Post, Stylesheet
 
-def get_blog():
-    """Get the single blog instance for personal CMS"""
-    blog = Blog.objects.first()
-    if not blog:
-        blog = Blog.objects.create(
-            title="My Personal Blog",
-            content="Welcome to my personal blog!"
-        )
-    return blog
-
 
 @login_required
 def nav(request):
-    blog = get_blog()
+    blog = get_blog(request)
 
     if request.method == "POST":
         form = NavForm(request.POST, instance=blog)
@@ -42,7 +32,7 @@ def nav(request):
 
 @login_required
 def styles(request):
-    blog = get_blog()
+    blog = get_blog(request)
 
     if request.method == "POST":
         stylesheet = request.POST.get("stylesheet")
@@ -78,14 +68,14 @@ def styles(request):
 @login_required
 def blog_delete(request):
     if request.method == "POST":
-        blog = get_blog()
+        blog = get_blog(request)
         blog.delete()
     return redirect('home')
 
 
 @login_required
 def posts_edit(request):
-    blog = get_blog()
+    blog = get_blog(request)
 
     posts = Post.objects.filter(blog=blog, is_page=False).order_by('-published_date')
 
@@ -97,7 +87,7 @@ def posts_edit(request):
 
 @login_required
 def pages_edit(request):
-    blog = get_blog()
+    blog = get_blog(request)
 
     posts = Post.objects.filter(blog=blog, is_page=True).order_by('-published_date')
 
@@ -111,7 +101,7 @@ def pages_edit(request):
 @login_required
 def post_delete(request, uid):
     if request.method == "POST":
-        blog = get_blog()
+        blog = get_blog(request)
         post = get_object_or_404(Post, blog=blog, uid=uid)
         is_page = post.is_page
         post.delete()
@@ -167,7 +157,7 @@ def upgrade(request):
 
 @login_required
 def opt_in_review(request):
-    blog = get_blog()
+    blog = get_blog(request)
 
     if request.method == 'POST':
         spam = request.POST.get("spam", "")
@@ -182,7 +172,7 @@ def opt_in_review(request):
 
 @login_required
 def settings(request):
-    blog = get_blog()
+    blog = get_blog(request)
     
     error_messages = []
     
@@ -2,13 +2,12 @@ from django.http import HttpResponse
 from django.shortcuts import render
 from django.views.decorators.csrf import csrf_exempt
 
-from blogs.models import Blog
-from blogs.views.blog import get_blog
+from blogs.helpers import get_blog
 
 
 def email_list(request):
     """Simplified email list - no subscribers in personal CMS"""
-    blog = get_blog()
+    blog = get_blog(request)
     # For personal CMS, just show a message that email subscriptions are not available
     return render(request, 'dashboard/email_list.html', {
         'blog': blog,
@@ -18,7 +17,7 @@ def email_list(request):
 
 def subscribe(request):
     """Simplified subscribe - not available in personal CMS"""
-    blog = get_blog()
+    blog = get_blog(request)
     return render(request, 'subscribe.html', {'blog': blog})
 
 
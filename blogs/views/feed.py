@@ -1,18 +1,40 @@
 from django.http import HttpResponse
 from django.utils import timezone
+from django.utils.cache import patch_vary_headers
+from django.views.decorators.http import condition
 
-from blogs.helpers import unmark
+from blogs.cache import LRUCache, content_etag, content_last_modified, get_content_version
+from blogs.helpers import get_blog
+from blogs.models import Post
 from blogs.templatetags.custom_tags import markdown
-from blogs.views.blog import not_found, get_blog
+from blogs.views.blog import not_found
 
 from feedgen.feed import FeedGenerator
+import gzip
 import re
 
 
+# Rendered feeds keyed by (content version, type, tag, encoding). Tagged feeds get their own,
+# bounded, cache so arbitrary ?q= values can't evict the main feeds or grow memory
+feed_snapshots = LRUCache(max_entries=16)
+tagged_feed_snapshots = LRUCache(max_entries=128, max_size=16 * 1024 * 1024)
+
+
 def clean_string(s):
     return re.sub(r'[\x00-\x08\x0B\x0C\x0E-\x1F\x7F]', '', s)
 
 
+def feed_encoding(request):
+    return 'gzip' if 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '') else None
+
+
+def feed_etag(request, *args, **kwargs):
+    # The compressed and identity bodies are different representations, so they can't share a strong ETag
+    etag = content_etag(request)
+    return f'{etag}-gzip' if feed_encoding(request) else etag
+
+
+@condition(etag_func=feed_etag, last_modified_func=content_last_modified)
 def feed(request):
     tag = request.GET.get('q')
 
@@ -21,23 +43,44 @@ def feed(request):
     else:
         feed_type = "atom"
 
-    blog = get_blog()
+    blog = get_blog(request)
     if not blog:
         return not_found(request)
+
+    encoding = feed_encoding(request)
     try:
-        feed = generate_feed(blog, feed_type, tag)
+        feed = get_feed_snapshot(blog, feed_type, tag, encoding)
     except Exception as e:
         print(f'Feeds: Error generating feed for {blog.subdomain}: {e}')
         feed = ''
         raise e
-    
+
     response = HttpResponse(feed, content_type='application/xml')
+    if encoding:
+        # Already compressed, GZipMiddleware leaves responses with a Content-Encoding alone
+        response['Content-Encoding'] = encoding
+    patch_vary_headers(response, ('Accept-Encoding',))
     response['Cache-Tag'] = blog.subdomain
     return response
 
 
+def get_feed_snapshot(blog, feed_type="atom", tag=None, encoding=None):
+    """Feed bytes, generated (and compressed) once per content version"""
+    snapshots = tagged_feed_snapshots if tag else feed_snapshots
+    key = (get_content_version(), feed_type, tag, encoding)
+
+    snapshot = snapshots.get(key)
+    if snapshot is None:
+        if encoding == 'gzip':
+            snapshot = gzip.compress(get_feed_snapshot(blog, feed_type, tag), mtime=0)
+        else:
+            snapshot = generate_feed(blog, feed_type, tag)
+        snapshots.set(key, snapshot)
+    return snapshot
+
+
 def generate_feed(blog, feed_type="atom", tag=None):
-    all_posts = blog.posts.filter(publish=True, is_page=False, published_date__lte=timezone.now())
+    all_posts = Post.objects.filter(publish=True, is_page=False, published_date__lte=timezone.now())
 
     if tag:
         all_posts = all_posts.filter(all_tags__icontains=tag)
@@ -50,7 +93,7 @@ def generate_feed(blog, feed_type="atom", tag=None):
     fg.id(blog.useful_domain)
     fg.author({'name': blog.subdomain, 'email': 'hidden'})
     fg.title(blog.title)
-    fg.subtitle(blog.meta_description or unmark(blog.content)[:157] + '...' or blog.title)
+    fg.subtitle(blog.description or blog.title)
     fg.link(href=f"{blog.useful_domain}/", rel='alternate')
 
     for post in all_posts:
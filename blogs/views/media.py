@@ -1,36 +1,38 @@
+from django.conf import settings
 from django.utils.text import slugify
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponse, HttpResponseForbidden
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseForbidden, HttpResponseNotModified
 from django.http import StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.http import http_date
 from django.views.decorators.csrf import csrf_exempt
 from django.shortcuts import get_object_or_404, redirect, render
 from django.utils import timezone
 from django.core.files.uploadedfile import InMemoryUploadedFile
+from django.db import IntegrityError, transaction
 from django.db.models import Q
 from zoneinfo import ZoneInfo
 
+import hashlib
 import io
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
-from PIL import Image, UnidentifiedImageError, ImageOps
+from PIL import UnidentifiedImageError
+import mimetypes
+import multiprocessing
 import re
 import json
 import os
 import requests
 import threading
 
-from blogs.models import Blog, Media
+from blogs.helpers import get_blog
+from blogs.images import transform_image
+from blogs.models import Blog, Media, MEDIA_BUCKET, MEDIA_URL_PREFIX
 
-def get_blog():
-    """Get the single blog instance for personal CMS"""
-    blog = Blog.objects.first()
-    if not blog:
-        blog = Blog.objects.create(
-            title="My Personal Blog",
-            content="Welcome to my personal blog!"
-        )
-    return blog
-
-bucket_name = 'bear-images'
+bucket_name = MEDIA_BUCKET
 
 
 image_types = ['png', 'jpg', 'jpeg', 'tiff', 'bmp', 'gif', 'svg', 'webp', 'avif', 'ico', 'heic']
@@ -46,7 +48,7 @@ file_size_limit = 10 * 1024 * 1024 # 10MB in bytes
 
 @login_required
 def media_center(request):
-    blog = get_blog()
+    blog = get_blog(request)
     
     # Skip upgrade check for personal CMS
 
@@ -54,26 +56,24 @@ def media_center(request):
 
     # Upload media
     if request.method == "POST" and request.FILES.getlist('file'):
-        file_links = upload_files(blog, request.FILES.getlist('file'))
-        for link in file_links:
-            if 'Error' in link:
-                error_messages.append(link)
+        statuses = upload_files(blog, request.FILES.getlist('file'))
+        error_messages = [status['error'] for status in statuses if 'error' in status]
 
     # Prefill blogs with existing images on the bucket
-    if not blog.media.exists():
+    if not Media.objects.exists() and os.getenv('SPACES_ACCESS_KEY_ID'):
         prefill_blog_media(blog)
 
     image_filter = Q()
     for ext in image_types + video_types:
         image_filter |= Q(url__iendswith=ext)
     
-    images = blog.media.filter(image_filter).order_by('-created_at')
+    images = Media.objects.filter(image_filter).order_by('-created_at')
 
     document_filter = Q()
     for ext in audio_types + document_types + font_types:
         document_filter |= Q(url__iendswith=ext)
 
-    documents = blog.media.filter(document_filter).order_by('-created_at')
+    documents = Media.objects.filter(document_filter).order_by('-created_at')
 
     accepted_file_types = ','.join([f'.{ext}' for ext in image_types + video_types + audio_types + document_types + font_types])
 
@@ -89,84 +89,200 @@ def media_center(request):
 @csrf_exempt
 @login_required
 def upload_image(request):
-    blog = get_blog()
+    blog = get_blog(request)
 
     if request.method == "POST":
-        file_links = upload_files(blog, request.FILES.getlist('file'))
+        statuses = upload_files(blog, request.FILES.getlist('file'))
+        file_links = [status.get('url') or status['error'] for status in statuses]
 
         return HttpResponse(json.dumps(sorted(file_links)), 200)
 
 
 def upload_files(blog, file_list):
-    file_links = []
+    """Uploads a batch of files concurrently, returning a status dict for each file in order"""
+    statuses = [{'name': file.name} for file in file_list]
 
-    for file in file_list:
-        # Fair use limit
-        if blog.media.count() > 20000:
-            file_links.append('Error: Fair usage limit exceeded. Contact site admin.')
-            return sorted(file_links)
+    # Fair use limit, counted once per batch
+    media_count = Media.objects.count()
 
+    # Files are stored by the hash of their contents, so uploading a file again reuses the stored copy
+    stored = {}
+    duplicates = []
+    batch_hashes = {}
+
+    # Images are transformed in the process pool while the rest of the batch is read
+    jobs = []
+    for status, file in zip(statuses, file_list):
         # Upload size limit
         if file.size > file_size_limit:
-            file_links.append(f'Error: File {file.name} exceeds 10MB limit')
-            break
-        
+            status['error'] = f'Error: File {file.name} exceeds 10MB limit'
+            continue
+
         # Only allowed file types but also explicitly excluding heic since Safari auto-converts it otherwise
         if not file.name.lower().endswith(tuple(file_types)) or file.name.lower().endswith('heic'):
-            file_links.append(f'Error: File type not supported: {file.name}')
-            break
-        
+            status['error'] = f'Error: File type not supported: {file.name}'
+            continue
+
+        data = file.read()
+        sha256 = hashlib.sha256(data).hexdigest()
+        if sha256 not in stored:
+            stored[sha256] = Media.objects.filter(sha256=sha256).only('url').first()
+        if stored[sha256]:
+            status['url'] = stored[sha256].url
+            continue
+        if sha256 in batch_hashes:
+            duplicates.append((status, batch_hashes[sha256]))
+            continue
+
+        if media_count > 20000:
+            status['error'] = 'Error: Fair usage limit exceeded. Contact site admin.'
+            continue
+
         extension = file.name.split('.')[-1].lower()
-        
+
         # Strip metadata if the file is an image
         if extension in image_types and not extension.endswith('svg') and not extension.endswith('gif'):
             try:
-                file = process_image(file, blog.optimise_images)
-            except UnidentifiedImageError:
-                file_links.append(f'Error: The image file cannot be identified or is not a valid image.')
-                break
-
-        file_name = slugify(file.name.split('.')[-2].lower())
-        extension = file.name.split('.')[-1].lower()
-
-        # Check for duplicate names
-        count = 0
-        new_file_name = file_name
-        while blog.media.filter(url__icontains=new_file_name).exists():
-            count += 1
-            new_file_name = f"{file_name}-{count}"
-        file_name = new_file_name
-        
-        filepath = f'{blog.subdomain}/{file_name}.{extension}'
-        url = f'https://{bucket_name}.sfo2.cdn.digitaloceanspaces.com/{filepath}'
-        file_links.append(url)
-
-        # Create Media object first
-        Media.objects.create(blog=blog, url=url)
-
-        # Read file data before starting thread
-        file_data = file.read()
-        content_type = file.content_type
-
-        # Move S3 upload to a thread
-        thread = threading.Thread(
-            target=save_locally,
-            args=(filepath, file_data, content_type)
-        )
-        thread.start()
-    
-    return sorted(file_links)
+                job = submit(
+                    get_image_pool(), transform_image, data, file.name, file.content_type, blog.optimise_images,
+                    settings.IMAGE_VARIANT_WIDTHS, settings.IMAGE_VARIANT_FORMATS
+                )
+            except UploadQueueFull:
+                status['error'] = f'Error: The server is busy, try uploading {file.name} again shortly'
+                continue
+        else:
+            job = (data, file.name, file.content_type, (None, None), [])
+
+        media_count += 1
+        batch_hashes[sha256] = status
+        jobs.append((status, sha256, len(data), job))
+
+    writes = []
+    for status, sha256, original_size, job in jobs:
+        try:
+            data, name, content_type, (width, height), variants = job.result(timeout=settings.UPLOAD_TIMEOUT) if isinstance(job, Future) else job
+        except UnidentifiedImageError:
+            status['error'] = 'Error: The image file cannot be identified or is not a valid image.'
+            continue
+        except BrokenProcessPool:
+            reset_image_pool()
+            status['error'] = f'Error: Could not process {status["name"]}'
+            continue
+        except Exception as e:
+            print(f'Error processing {status["name"]}: {e}')
+            status['error'] = f'Error: Could not process {status["name"]}'
+            continue
+
+        if isinstance(job, Future):
+            log_compression(original_size, len(data))
+
+        media = create_media(blog, name, sha256, width, height)
+
+        files = [(f'{blog.subdomain}/{media.name}', data, content_type)]
+        variant_urls = []
+        stem = media.name.rsplit('.', 1)[0]
+        for variant_width, variant_extension, variant_content_type, variant_data in variants:
+            # Slugified names never contain a dot, so variant names can't clash with an upload's
+            variant_path = f'{blog.subdomain}/{stem}.{variant_width}w.{variant_extension}'
+            files.append((variant_path, variant_data, variant_content_type))
+            variant_urls.append({'url': f'{MEDIA_URL_PREFIX}{variant_path}', 'width': variant_width, 'content_type': variant_content_type})
+        if variant_urls:
+            media.variants = json.dumps(variant_urls)
+            media.save(update_fields=['variants'])
+
+        try:
+            writes.append((status, media, [submit(write_pool, save_locally, *file) for file in files]))
+        except UploadQueueFull:
+            media.delete()
+            status['error'] = f'Error: The server is busy, try uploading {status["name"]} again shortly'
+
+    for status, media, file_writes in writes:
+        try:
+            for write in file_writes:
+                write.result(timeout=settings.UPLOAD_TIMEOUT)
+            status['url'] = media.url
+        except Exception:
+            media.delete()
+            status['error'] = f'Error: Could not save {status["name"]}'
+
+    # Files uploaded twice in the same batch share the first one's outcome
+    for status, first_status in duplicates:
+        status.update({key: value for key, value in first_status.items() if key != 'name'})
+
+    return statuses
+
+
+def create_media(blog, file_name, sha256, width, height):
+    """Creates the Media for an upload, which takes its name"""
+    stem = slugify(file_name.split('.')[-2].lower())
+    extension = file_name.split('.')[-1].lower()
+    for attempt in range(5):
+        name = Media.allocate_name(stem, extension)
+        try:
+            with transaction.atomic():
+                return Media.objects.create(
+                    url=f'{MEDIA_URL_PREFIX}{blog.subdomain}/{name}',
+                    name=name,
+                    sha256=sha256,
+                    width=width,
+                    height=height,
+                )
+        except IntegrityError:
+            # Taken by a concurrent upload since the lookup
+            if attempt == 4:
+                raise
+
+
+class UploadQueueFull(Exception):
+    pass
+
+
+# CPU heavy image transforms run in a process pool, disk writes in a thread pool. Both share a bounded
+# number of queued jobs per process so a burst of uploads waits for a slot rather than queueing unbounded work
+_image_pool = None
+_image_pool_lock = threading.Lock()
+write_pool = ThreadPoolExecutor(max_workers=settings.MEDIA_WRITE_WORKERS, thread_name_prefix='media-write')
+upload_slots = threading.BoundedSemaphore(settings.UPLOAD_QUEUE_SIZE)
+
+
+def get_image_pool():
+    global _image_pool
+    with _image_pool_lock:
+        if _image_pool is None:
+            # Spawned rather than forked, forking a threaded web worker isn't safe
+            _image_pool = ProcessPoolExecutor(max_workers=settings.IMAGE_PROCESS_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return _image_pool
+
+
+def reset_image_pool():
+    global _image_pool
+    with _image_pool_lock:
+        if _image_pool is not None:
+            _image_pool.shutdown(wait=False, cancel_futures=True)
+        _image_pool = None
+
+
+def submit(pool, function, *args):
+    if not upload_slots.acquire(timeout=settings.UPLOAD_QUEUE_TIMEOUT):
+        raise UploadQueueFull()
+    try:
+        future = pool.submit(function, *args)
+    except Exception:
+        upload_slots.release()
+        raise
+    future.add_done_callback(lambda _: upload_slots.release())
+    return future
 
 
 def save_locally(filepath, file_data, content_type):
     """Save file locally for personal CMS"""
     try:
         # Create media directory if it doesn't exist
-        media_dir = os.path.join('media', os.path.dirname(filepath))
+        media_dir = os.path.join(settings.MEDIA_ROOT, os.path.dirname(filepath))
         os.makedirs(media_dir, exist_ok=True)
 
         # Save file
-        full_path = os.path.join('media', filepath)
+        full_path = os.path.join(settings.MEDIA_ROOT, filepath)
         with open(full_path, 'wb') as f:
             f.write(file_data)
 
@@ -178,54 +294,31 @@ def save_locally(filepath, file_data, content_type):
 
 
 def process_image(file, optimise):
-    original_image = Image.open(file)
-    # Keeps orientation information
-    image = ImageOps.exif_transpose(original_image)
-
-    data = io.BytesIO()
-
-    if optimise:
-        max_width = 1200
-        if image.width > max_width:
-            # Calculate the new height to maintain the aspect ratio
-            ratio = max_width / float(image.width)
-            new_height = int(float(image.height) * ratio)
-            # Resize the image with high-quality resampling
-            image = image.resize((max_width, new_height), resample=Image.LANCZOS)
-
-        image.save(data, format='WEBP')
-        # Update file name and content type for WebP
-        file_name = os.path.splitext(file.name)[0] + '.webp'
-        content_type = 'image/webp'
-    else:
-        if image.mode == 'P':
-            image = image.convert('RGB')
-        # Save the image to strip metadata (EXIF, etc.)
-        image.save(data, format=original_image.format)
-        file_name = file.name
-        content_type = file.content_type
+    """Transforms an uploaded image in the calling thread"""
+    data, file_name, content_type, _, _ = transform_image(file.read(), file.name, file.content_type, optimise)
+    log_compression(file.size, len(data))
+
+    return InMemoryUploadedFile(
+        file=io.BytesIO(data),
+        field_name=None,
+        name=file_name,
+        content_type=content_type,
+        size=len(data),
+        charset=None
+    )
 
-    data.seek(0)
 
+def log_compression(original_size, new_size):
     print('Stripped metadata')
 
-    original_size = file.size / 1024
-    new_size = len(data.getvalue()) / 1024
+    original_size = original_size / 1024
+    new_size = new_size / 1024
     compression_rate = (original_size - new_size) / original_size * 100 if original_size != 0 else 0
 
     print(f'Original size: {original_size:.2f} KB')
     print(f'New size: {new_size:.2f} KB')
     print(f'Compression rate: {compression_rate:.2f}%')
 
-    return InMemoryUploadedFile(
-        file=data,
-        field_name=None,
-        name=file_name,
-        content_type=content_type,
-        size=len(data.getvalue()),
-        charset=None
-    )
-
 
 def prefill_blog_media(blog):
     uploaded_images = get_uploaded_images(blog)
@@ -273,7 +366,7 @@ def get_uploaded_images(blog):
 
 @login_required
 def delete_selected_media(request):
-    blog = get_blog()
+    blog = get_blog(request)
     
     if request.method == "POST":
         selected_media = request.POST.getlist('selected_media')
@@ -304,20 +397,123 @@ def delete_selected_media(request):
 
 
 def image_proxy(request, img):
-    # Construct the DigitalOcean Spaces URL
-    remote_url = f'https://{bucket_name}.sfo2.cdn.digitaloceanspaces.com/{img}'
-    
-    # Stream the content from the remote URL
-    response = requests.get(remote_url, stream=True, timeout=10)
-    
-    # Define a generator to yield chunks of the response content
-    def generate():
-        for chunk in response.iter_content(chunk_size=8192):
+    """Serve uploaded media from MEDIA_ROOT, falling back to the bucket for files that aren't stored locally"""
+    path = local_media_path(img)
+    if path is None:
+        return proxy_media(request, img)
+
+    stat = os.stat(path)
+    etag = f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+    if etag in request.headers.get('If-None-Match', ''):
+        return add_media_headers(HttpResponseNotModified(), etag, stat)
+
+    content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+    if settings.MEDIA_SENDFILE:
+        # The web server sends the file (and handles Range), Django only checks it exists
+        response = HttpResponse(content_type=content_type)
+        relative_path = os.path.relpath(path, settings.MEDIA_ROOT)
+        if settings.MEDIA_SENDFILE == 'x-accel-redirect':
+            response['X-Accel-Redirect'] = f"{settings.MEDIA_SENDFILE_PREFIX.rstrip('/')}/{relative_path}"
+        else:
+            response['X-Sendfile'] = path
+        return add_media_headers(response, etag, stat)
+
+    byte_range = parse_range(request.headers.get('Range'), stat.st_size)
+    if byte_range == 'unsatisfiable':
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{stat.st_size}'
+        return response
+
+    if byte_range:
+        start, end = byte_range
+        response = StreamingHttpResponse(read_range(path, start, end), status=206, content_type=content_type)
+        response['Content-Length'] = end - start + 1
+        response['Content-Range'] = f'bytes {start}-{end}/{stat.st_size}'
+    else:
+        # Served through wsgi.file_wrapper, so the WSGI server can use os.sendfile
+        response = FileResponse(open(path, 'rb'), content_type=content_type)
+    return add_media_headers(response, etag, stat)
+
+
+def local_media_path(img):
+    # Uploads are stored as <subdomain>/<name>, older links only carry the name
+    for candidate in (img, f'{get_blog().subdomain}/{img}'):
+        try:
+            path = safe_join(settings.MEDIA_ROOT, candidate)
+        except SuspiciousFileOperation:
+            raise Http404()
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def add_media_headers(response, etag, stat):
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    response['Accept-Ranges'] = 'bytes'
+    # Uploads get a unique name and are never modified
+    response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+
+def parse_range(header, size):
+    """(start, end) of a single "bytes=" range, None to send the whole file"""
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', (header or '').strip())
+    if not match or match.groups() == ('', ''):
+        # Missing, malformed and multipart ranges are answered with the whole file
+        return None
+
+    start, end = match.groups()
+    if start == '':
+        # Suffix range, the last N bytes
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+
+    if start >= size or start > end:
+        return 'unsatisfiable'
+    return start, end
+
+
+def read_range(path, start, end, chunk_size=64 * 1024):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
             yield chunk
-    
-    # Return a StreamingHttpResponse
-    return StreamingHttpResponse(
-        generate(),
-        status=response.status_code,
-        content_type=response.headers['Content-Type']
-    )
\ No newline at end of file
+
+
+# One pooled session for fetching media that only exists in the bucket
+upstream_session = requests.Session()
+upstream_session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+UPSTREAM_HEADERS = ('Content-Type', 'Content-Length', 'Content-Range', 'Accept-Ranges', 'ETag', 'Last-Modified', 'Cache-Control')
+
+
+def proxy_media(request, img):
+    remote_url = f'{MEDIA_URL_PREFIX}{img}'
+    headers = {name: request.headers[name] for name in ('Range', 'If-None-Match', 'If-Modified-Since') if name in request.headers}
+
+    try:
+        upstream = upstream_session.get(remote_url, headers=headers, stream=True, timeout=10)
+    except requests.RequestException as e:
+        print(f'Media: Error fetching {remote_url}: {e}')
+        return HttpResponse(status=502)
+
+    def generate():
+        try:
+            yield from upstream.iter_content(chunk_size=64 * 1024)
+        finally:
+            # Returns the connection to the pool
+            upstream.close()
+
+    response = StreamingHttpResponse(generate(), status=upstream.status_code)
+    for name in UPSTREAM_HEADERS:
+        if name in upstream.headers:
+            response[name] = upstream.headers[name]
+    return response
@@ -14,22 +14,12 @@ import json
 import random
 import string
 
-from blogs.backup import backup_in_thread
+from blogs.backup import backup_in_background
 from blogs.forms import AdvancedSettingsForm, BlogForm, PostTemplateForm
-from blogs.helpers import check_connection, is_protected, salt_and_hash
+from blogs.helpers import check_connection, get_blog, is_protected, salt_and_hash
 from blogs.models import Blog, Post
 from blogs.subscriptions import get_subscriptions
 
-def get_blog():
-    """Get the single blog instance for personal CMS"""
-    blog = Blog.objects.first()
-    if not blog:
-        blog = Blog.objects.create(
-            title="My Personal Blog",
-            content="Welcome to my personal blog!"
-        )
-    return blog
-
 
 @login_required
 def list(request):
@@ -39,7 +29,7 @@ def list(request):
 
 @login_required
 def studio(request):
-    blog = get_blog()
+    blog = get_blog(request)
 
     error_messages = []
     header_content = request.POST.get('header_content', '')
@@ -110,7 +100,7 @@ def parse_raw_homepage(blog, header_content, body_content):
 
 @login_required
 def post(request, uid=None):
-    blog = get_blog()
+    blog = get_blog(request)
 
     is_page = request.GET.get('is_page', '')
     tags = []
@@ -149,7 +139,6 @@ def post(request, uid=None):
 
         try:
             # Clear out data
-            slug = ''
             post.alias = ''
             post.class_name = ''
             post.canonical_url = ''
@@ -161,76 +150,8 @@ def post(request, uid=None):
             post.all_tags = '[]'
 
             # Parse and populate header data
-            for item in raw_header:
-                item = item.split(':', 1)
-                name = item[0].strip()
-
-                # Prevent index error
-                if len(item) == 2:
-                    value = item[1].strip()
-                else:
-                    value = ''
-
-                if str(value).lower() == 'true':
-                    value = True
-                if str(value).lower() == 'false':
-                    value = False
-
-                if name == 'title':
-                    post.title = value
-                elif name == 'link':
-                    slug = value
-                elif name == 'alias':
-                    post.alias = value
-                elif name == 'published_date':
-                    if not value:
-                        post.published_date = timezone.now()
-                    else:
-                        value = str(value).replace('/', '-')
-                        try:
-                            # Convert given date/time from local timezone to UTC
-                            naive_datetime = datetime.fromisoformat(value)
-                            user_timezone = request.COOKIES.get('timezone', 'UTC')
-
-                            try:
-                                user_tz = ZoneInfo(user_timezone)
-                            except Exception as e:
-                                user_tz = ZoneInfo('UTC')
-
-                            aware_datetime = timezone.make_aware(naive_datetime, user_tz)
-                            utc_datetime = aware_datetime.astimezone(ZoneInfo('UTC'))
-                            post.published_date = utc_datetime
-                        except Exception as e:
-                            error_messages.append('Bad date format. Use YYYY-MM-DD HH:MM')
-                elif name == 'tags':
-                    tags = []
-                    for tag in value.split(','):
-                        stripped_tag = tag.strip()
-                        if stripped_tag and stripped_tag not in tags:
-                            tags.append(stripped_tag)
-                    post.all_tags = json.dumps(tags)
-                elif name == 'make_discoverable':
-                    if type(value) is bool:
-                        post.make_discoverable = value
-                    else:
-                        error_messages.append('make_discoverable needs to be "true" or "false"')
-                elif name == 'is_page':
-                    if type(value) is bool:
-                        post.is_page = value
-                    else:
-                        error_messages.append('is_page needs to be "true" or "false"')
-                elif name == 'class_name':
-                    post.class_name = slugify(value)
-                elif name == 'canonical_url':
-                    post.canonical_url = value
-                elif name == 'lang':
-                    post.lang = value
-                elif name == 'meta_description':
-                    post.meta_description = value
-                elif name == 'meta_image':
-                    post.meta_image = value
-                else:
-                    error_messages.append(f"{name} is an unrecognised header option")
+            slug, header_errors = parse_post_header(post, raw_header, request.COOKIES.get('timezone', 'UTC'))
+            error_messages.extend(header_errors)
 
             if not post.title:
                 post.title = "New post"
@@ -251,7 +172,7 @@ def post(request, uid=None):
                 post.save()
                 
                 # Backup blog
-                backup_in_thread(blog)
+                backup_in_background(blog)
                 
                 if is_new:
                     # Redirect to the new post edit view
@@ -278,7 +199,85 @@ def post(request, uid=None):
     })
 
 
-def unique_slug(blog, post, new_slug):
+def parse_post_header(post, raw_header, user_timezone='UTC'):
+    """Applies "name: value" header lines to the post, returns the requested slug and any errors"""
+    slug = ''
+    error_messages = []
+
+    for item in raw_header:
+        item = item.split(':', 1)
+        name = item[0].strip()
+
+        # Prevent index error
+        if len(item) == 2:
+            value = item[1].strip()
+        else:
+            value = ''
+
+        if str(value).lower() == 'true':
+            value = True
+        if str(value).lower() == 'false':
+            value = False
+
+        if name == 'title':
+            post.title = value
+        elif name == 'link':
+            slug = value
+        elif name == 'alias':
+            post.alias = value
+        elif name == 'published_date':
+            if not value:
+                post.published_date = timezone.now()
+            else:
+                value = str(value).replace('/', '-')
+                try:
+                    # Convert given date/time from local timezone to UTC
+                    naive_datetime = datetime.fromisoformat(value)
+
+                    try:
+                        user_tz = ZoneInfo(user_timezone)
+                    except Exception as e:
+                        user_tz = ZoneInfo('UTC')
+
+                    aware_datetime = timezone.make_aware(naive_datetime, user_tz)
+                    utc_datetime = aware_datetime.astimezone(ZoneInfo('UTC'))
+                    post.published_date = utc_datetime
+                except Exception as e:
+                    error_messages.append('Bad date format. Use YYYY-MM-DD HH:MM')
+        elif name == 'tags':
+            tags = []
+            for tag in value.split(','):
+                stripped_tag = tag.strip()
+                if stripped_tag and stripped_tag not in tags:
+                    tags.append(stripped_tag)
+            post.all_tags = json.dumps(tags)
+        elif name == 'make_discoverable':
+            if type(value) is bool:
+                post.make_discoverable = value
+            else:
+                error_messages.append('make_discoverable needs to be "true" or "false"')
+        elif name == 'is_page':
+            if type(value) is bool:
+                post.is_page = value
+            else:
+                error_messages.append('is_page needs to be "true" or "false"')
+        elif name == 'class_name':
+            post.class_name = slugify(value)
+        elif name == 'canonical_url':
+            post.canonical_url = value
+        elif name == 'lang':
+            post.lang = value
+        elif name == 'meta_description':
+            post.meta_description = value
+        elif name == 'meta_image':
+            post.meta_image = value
+        else:
+            error_messages.append(f"{name} is an unrecognised header option")
+
+    return slug, error_messages
+
+
+def clean_slug(new_slug):
     # Clean the new_slug to be alphanumeric lowercase with only '/', '_' and '-' allowed
     cleaned_slug = ''.join(c for c in new_slug.lower() if c.isalnum() or c == '/' or c == '-' or c == '_')
 
@@ -287,6 +286,11 @@ def unique_slug(blog, post, new_slug):
         cleaned_slug = cleaned_slug[:-1]
     if len(cleaned_slug) > 0 and cleaned_slug[0] == '/':
         cleaned_slug = cleaned_slug[1:]
+    return cleaned_slug
+
+
+def unique_slug(blog, post, new_slug):
+    cleaned_slug = clean_slug(new_slug)
 
     # If the cleaned slug is empty, use the title
     if cleaned_slug == '':
@@ -306,7 +310,7 @@ def unique_slug(blog, post, new_slug):
 @csrf_exempt
 @login_required
 def preview(request):
-    blog = get_blog()
+    blog = get_blog(request)
 
     post = Post(blog=blog)
 
@@ -405,7 +409,7 @@ def preview(request):
 
 @login_required
 def post_template(request):
-    blog = get_blog()
+    blog = get_blog(request)
 
     if request.method == "POST":
         form = PostTemplateForm(request.POST, instance=blog)
@@ -422,7 +426,7 @@ def post_template(request):
 
 @login_required
 def custom_domain_edit(request):
-    blog = get_blog()
+    blog = get_blog(request)
 
     # Upgrades are not supported in personal CMS; allow access
 
@@ -458,7 +462,7 @@ def custom_domain_edit(request):
 
 @login_required
 def directive_edit(request):
-    blog = get_blog()
+    blog = get_blog(request)
 
     # Upgrades are not supported in personal CMS; allow access
 
@@ -477,7 +481,7 @@ def directive_edit(request):
 
 @login_required
 def advanced_settings(request):
-    blog = get_blog()
+    blog = get_blog(request)
 
     if request.method == "POST":
         form = AdvancedSettingsForm(request.POST, instance=blog)
@@ -38,7 +38,7 @@ AUTHENTICATION_BACKENDS = (
 )
 
 MIDDLEWARE = [
-    'django.middleware.gzip.GZipMiddleware',
+    'blogs.middleware.GZipMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -48,6 +48,29 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# Per-endpoint request timings, viewable at /dashboard/performance/ (stored in Redis when REDISCLOUD_URL is set)
+REQUEST_METRICS_ENABLED = os.getenv('REQUEST_METRICS_ENABLED', 'False') == 'True'
+if REQUEST_METRICS_ENABLED:
+    MIDDLEWARE.insert(1, 'blogs.middleware.RequestPerformanceMiddleware')
+
+# Per-IP request limiting. The memory backend is per process, use cache or redis to share limits between workers
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'False') == 'True'
+RATE_LIMIT_BACKEND = os.getenv('RATE_LIMIT_BACKEND', 'memory')  # memory, cache or redis
+# Dotted view paths or URL names. Uptime checks and the domain verification ping are never limited
+RATE_LIMIT_EXEMPT_VIEWS = [
+    'blogs.views.feed.feed',
+    'ping',
+]
+if RATE_LIMIT_ENABLED:
+    MIDDLEWARE.insert(MIDDLEWARE.index('whitenoise.middleware.WhiteNoiseMiddleware') + 1, 'blogs.middleware.RateLimitMiddleware')
+
+# Per-stage timings (Server-Timing header) for a sample of requests, summarised at /dashboard/profiling/
+PROFILING_ENABLED = os.getenv('PROFILING_ENABLED', 'False') == 'True'
+PROFILING_SAMPLE_RATE = float(os.getenv('PROFILING_SAMPLE_RATE', 0.1))
+if PROFILING_ENABLED:
+    MIDDLEWARE[MIDDLEWARE.index('blogs.middleware.GZipMiddleware')] = 'blogs.middleware.ProfiledGZipMiddleware'
+    MIDDLEWARE.insert(0, 'blogs.middleware.ProfilingMiddleware')
+
 ROOT_URLCONF = 'conf.urls'
 TEMPLATES = [
     {
@@ -68,6 +91,8 @@ TEMPLATES = [
         },
     },
 ]
+if PROFILING_ENABLED:
+    TEMPLATES[0]['BACKEND'] = 'blogs.profiling.ProfiledDjangoTemplates'
 
 
 WSGI_APPLICATION = 'conf.wsgi.application'
@@ -80,7 +105,74 @@ DATABASES = {
     }
 }
 
+# Caching
+# The markdown cache holds rendered post markup keyed by content hash.
+# LocMemCache evicts least recently used entries once MAX_ENTRIES is reached.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'markdown': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'markdown',
+        'TIMEOUT': None,
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.getenv('MARKDOWN_CACHE_MAX_ENTRIES', 1000)),
+        },
+    },
+}
+# Each worker process keeps its own copy of cached pages unless the default cache is shared
+if os.getenv('REDISCLOUD_URL'):
+    CACHES['default'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.getenv('REDISCLOUD_URL'),
+    }
+
+MARKDOWN_CACHE_MAX_ENTRY_SIZE = int(os.getenv('MARKDOWN_CACHE_MAX_ENTRY_SIZE', 256 * 1024))  # bytes
+
+# Serve the blog's stylesheet inline in every page rather than as a cacheable /styles/<hash>.css file
+INLINE_STYLES = os.getenv('INLINE_STYLES', 'False') == 'True'
+
+# How long a worker reuses the content version it read from the database before checking it again.
+# Changes made in other worker processes take up to this long to show
+CONTENT_VERSION_POLL_INTERVAL = float(os.getenv('CONTENT_VERSION_POLL_INTERVAL', 1))  # seconds
+
+# Public pages are cached until the content changes, but expire anyway so relative dates stay fresh
+PAGE_CACHE_TIMEOUT = int(os.getenv('PAGE_CACHE_TIMEOUT', 600))  # seconds
+
 DATA_UPLOAD_MAX_MEMORY_SIZE = 10485760  # 10 MB
+
+# Uploaded images are transformed in a pool of processes and written to disk by a pool of threads.
+# Uploads wait up to UPLOAD_QUEUE_TIMEOUT for one of the UPLOAD_QUEUE_SIZE slots before being turned away
+IMAGE_PROCESS_WORKERS = int(os.getenv('IMAGE_PROCESS_WORKERS', min(4, os.cpu_count() or 1)))
+MEDIA_WRITE_WORKERS = int(os.getenv('MEDIA_WRITE_WORKERS', 4))
+UPLOAD_QUEUE_SIZE = int(os.getenv('UPLOAD_QUEUE_SIZE', 32))
+UPLOAD_QUEUE_TIMEOUT = int(os.getenv('UPLOAD_QUEUE_TIMEOUT', 30))  # seconds
+UPLOAD_TIMEOUT = int(os.getenv('UPLOAD_TIMEOUT', 60))  # seconds
+
+# Resized copies of uploaded images, offered to browsers through srcset. AVIF is skipped when Pillow can't encode it
+IMAGE_VARIANT_WIDTHS = [int(width) for width in os.getenv('IMAGE_VARIANT_WIDTHS', '320,640,1200,2400').split(',') if width]
+IMAGE_VARIANT_FORMATS = [f for f in os.getenv('IMAGE_VARIANT_FORMATS', 'webp,avif').split(',') if f]
+IMAGE_SIZES = os.getenv('IMAGE_SIZES', '(max-width: 800px) 100vw, 800px')
+
+# Uploads are stored here and served from /media/. Set MEDIA_SENDFILE to x-accel-redirect (nginx, Caddy) or
+# x-sendfile (Apache) to hand the transfer to the web server, which must map MEDIA_SENDFILE_PREFIX to MEDIA_ROOT
+MEDIA_ROOT = os.getenv('MEDIA_ROOT', BASE_DIR / 'media')
+MEDIA_SENDFILE = os.getenv('MEDIA_SENDFILE', '')
+MEDIA_SENDFILE_PREFIX = os.getenv('MEDIA_SENDFILE_PREFIX', '/protected-media/')
+
+# Background jobs (backups, post stats, emails) run on JOB_WORKERS threads in each web process, or with
+# JOB_BACKEND = 'database' are stored in the Job table and run by `manage.py run_jobs`, which must then be kept running
+JOB_BACKEND = os.getenv('JOB_BACKEND', 'thread')  # thread or database
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+JOB_QUEUE_SIZE = int(os.getenv('JOB_QUEUE_SIZE', 1000))
+JOB_RETRIES = int(os.getenv('JOB_RETRIES', 3))
+JOB_RETRY_DELAY = int(os.getenv('JOB_RETRY_DELAY', 10))  # seconds, doubled on every attempt
+BACKUP_DELAY = int(os.getenv('BACKUP_DELAY', 30))  # seconds, saves within this window share one backup
+
+# Incremental backups taken after every save (see blogs/backup.py), restored with `manage.py restore_backup`
+BACKUP_ROOT = os.getenv('BACKUP_ROOT', BASE_DIR / 'backups')
+
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # Password validation